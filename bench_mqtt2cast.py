@@ -0,0 +1,717 @@
+#!/usr/bin/python3
+"""
+Benchmarks for mqtt2cast which need neither cast devices nor a broker.
+
+pychromecast.Chromecast, paho's mqtt.Client, the subnet probe and
+urlopen are replaced by in-process fakes with configurable latency and
+failure rate. The scenarios drive the real code paths
+(on_message -> TopicRouter -> CommandDispatcher -> wrappers ->
+CastDeviceWrapper -> result/event publishing) and the numbers are
+written as a json report, e.g.
+
+./bench_mqtt2cast.py --devices 50 --latency_ms 5 --report bench.json
+
+With --replay it instead feeds traffic recorded with
+mqtt2cast.py --record back against the fakes, e.g.
+
+./bench_mqtt2cast.py --replay traffic.jsonl --speed 10
+"""
+
+from typing import List, Dict, Optional, Any
+
+import argparse
+import asyncio
+import collections
+import io
+import ipaddress
+import json
+import logging
+import platform
+import queue
+import random
+import sys
+import threading
+import time
+
+import pychromecast
+
+import mqtt2cast
+
+PARSER = argparse.ArgumentParser(description="mqtt2cast benchmarks")
+PARSER.add_argument("--devices", type=int, default=50,
+                    help="number of simulated cast devices")
+PARSER.add_argument("--latency_ms", type=float, default=5.0,
+                    help="mean response time of a simulated device call")
+PARSER.add_argument("--connect_ms", type=float, default=20.0,
+                    help="time to connect to a simulated device")
+PARSER.add_argument("--probe_ms", type=float, default=2.0,
+                    help="time to probe a host of the simulated subnet")
+PARSER.add_argument("--failure_rate", type=float, default=0.0,
+                    help="fraction of device calls which fail")
+PARSER.add_argument("--commands", type=int, default=1000,
+                    help="number of commands for the dispatch scenario")
+PARSER.add_argument("--broadcasts", type=int, default=20,
+                    help="number of broadcasts for the fan-out scenario")
+PARSER.add_argument("--playlist_size", type=int, default=200,
+                    help="songs per simulated playlist")
+PARSER.add_argument("--sync_size", type=int, default=8,
+                    help="number of devices in the group of the sync scenario")
+PARSER.add_argument("--syncs", type=int, default=5,
+                    help="number of synchronized starts in the sync scenario")
+PARSER.add_argument("--volume_steps", type=int, default=100,
+                    help="set_volume commands per device in the volume storm")
+PARSER.add_argument("--subnet", default="10.0.0.0/20",
+                    help="simulated subnet for the discovery scenario")
+PARSER.add_argument("--scenario", action="append",
+                    help="only run these scenarios (default: all)")
+PARSER.add_argument("--seed", type=int, default=1,
+                    help="seed for latency jitter and failures")
+PARSER.add_argument("--timeout", type=float, default=120.0,
+                    help="max seconds to wait for the results of a scenario")
+PARSER.add_argument("--replay", default="",
+                    help="replay this recording (mqtt2cast.py --record) instead of running the scenarios")
+PARSER.add_argument("--speed", type=float, default=1.0,
+                    help="replay speed factor, 0 means as fast as possible")
+PARSER.add_argument("--sample_interval", type=float, default=0.1,
+                    help="seconds between queue depth samples during a replay")
+PARSER.add_argument("--report", default="",
+                    help="write the json report to this file instead of stdout")
+PARSER.add_argument("--verbose", action="store_true", default=False)
+PARSER.add_argument("bridge_args", nargs="*",
+                    help="extra mqtt2cast flags (after --), e.g. -- --coalesce_window_ms=20")
+
+ARGS = PARSER.parse_args([])
+RANDOM = random.Random()
+
+
+def Percentiles(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 6)
+    return {"count": len(values),
+            "mean": round(sum(values) / len(values), 6),
+            "p50": at(0.50),
+            "p90": at(0.90),
+            "p99": at(0.99),
+            "max": round(values[-1], 6)}
+
+
+############################################################
+# Fake Broker
+# Stands in for paho's mqtt.Client: publishes are recorded and
+# acknowledged from a separate thread like a real broker would.
+############################################################
+class FakeMessage:
+
+    def __init__(self, topic: str, payload: str):
+        self.topic = topic
+        self.payload = payload.encode("utf-8")
+
+
+class FakeMessageInfo:
+
+    def __init__(self, mid: int):
+        self.rc = mqtt2cast.mqtt.MQTT_ERR_SUCCESS
+        self.mid = mid
+
+
+class FakeBroker:
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.published = 0
+        self.topics: collections.Counter = collections.Counter()
+        # correlation id -> (time, result)
+        self.results: Dict[str, Any] = {}
+        # broadcast action -> outcomes
+        self.broadcasts: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
+        # reports of synchronized starts
+        self.syncs: List[Dict[str, Any]] = []
+        self.acks: queue.Queue = queue.Queue()
+        self.client: Optional["FakeMqttClient"] = None
+        threading.Thread(target=self._Ack, name="fake-broker", daemon=True).start()
+
+    def Publish(self, topic: str, payload) -> int:
+        now = time.monotonic()
+        kind = topic[len(mqtt2cast.MESSAGE_PREFIX):].split("/")[0]
+        with self.cond:
+            self.published += 1
+            mid = self.published
+            self.topics[kind] += 1
+            if kind == "result":
+                result = json.loads(payload)
+                self.results[result["id"]] = (now, result)
+            elif kind == "broadcast":
+                self.broadcasts[topic.split("/")[-1]].append(json.loads(payload))
+            elif kind == "sync":
+                self.syncs.append(json.loads(payload))
+            self.cond.notify_all()
+        self.acks.put(mid)
+        return mid
+
+    def _Ack(self):
+        while True:
+            mid = self.acks.get()
+            if self.client and self.client.on_publish:
+                self.client.on_publish(self.client, None, mid)
+
+    def Deliver(self, topic: str, payload: str):
+        """Like paho's network thread: on_message runs in the caller's thread"""
+        self.client.on_message(self.client, None, FakeMessage(topic, payload))
+
+    def WaitFor(self, predicate, timeout: float) -> bool:
+        with self.cond:
+            return self.cond.wait_for(predicate, timeout)
+
+    def Reset(self):
+        with self.cond:
+            self.results.clear()
+            self.broadcasts.clear()
+            self.syncs.clear()
+
+
+BROKER: Optional[FakeBroker] = None
+
+
+class FakeMqttClient:
+
+    def __init__(self, name: str):
+        global BROKER
+        self.name = name
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_message = None
+        self.on_log = None
+        BROKER.client = self
+
+    def will_set(self, topic, payload, retain=False):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def connect(self, host, port, keepalive=60):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, 0, None)
+
+    def subscribe(self, topic):
+        pass
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        global BROKER
+        return FakeMessageInfo(BROKER.Publish(topic, payload))
+
+
+############################################################
+# Fake Cast Devices
+# Every call sleeps for about ARGS.latency_ms and fails with
+# ARGS.failure_rate. Status listeners are notified like the
+# real pychromecast does from its socket thread.
+############################################################
+DeviceStatus = collections.namedtuple(
+    "DeviceStatus", ["friendly_name", "model_name", "manufacturer", "uuid", "cast_type"])
+
+
+def SimulateCall(latency_ms: float):
+    time.sleep(RANDOM.expovariate(1.0 / latency_ms) / 1000.0 if latency_ms > 0 else 0)
+    if RANDOM.random() < ARGS.failure_rate:
+        raise pychromecast.error.PyChromecastError("simulated failure")
+
+
+class FakeMediaStatus:
+
+    def __init__(self):
+        self.content_id = ""
+        self.content_type = ""
+        self.player_state = "IDLE"
+        self.idle_reason = None
+        self.current_time = 0.0
+        self.media_session_id = 1
+        self.volume_level = 1.0
+
+
+class FakeCastStatus:
+
+    def __init__(self):
+        self.volume_level = 0.5
+        self.app_id = None
+        self.display_name = None
+
+
+class FakeMediaController:
+
+    def __init__(self):
+        self.status = FakeMediaStatus()
+        self.listeners = []
+
+    def register_status_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _Notify(self, content_id: str, player_state: str):
+        self.status.content_id = content_id
+        self.status.player_state = player_state
+        for listener in self.listeners:
+            listener.new_media_status(self.status)
+
+    def play_media(self, url, content_type="", enqueue=False):
+        SimulateCall(ARGS.latency_ms)
+        self._Notify(url, "PLAYING" if url else "IDLE")
+
+    def send_message(self, data, inc_session_id=False):
+        SimulateCall(ARGS.latency_ms)
+        if data.get("type") == "QUEUE_LOAD":
+            first = data["items"][0]
+            # buffering takes a bit longer than a plain call
+            SimulateCall(ARGS.latency_ms)
+            self._Notify(first["media"]["contentId"],
+                         "PLAYING" if first["autoplay"] else "PAUSED")
+
+    def play(self):
+        SimulateCall(ARGS.latency_ms)
+        self._Notify(self.status.content_id, "PLAYING")
+
+    def block_until_active(self, timeout=None):
+        pass
+
+    def queue_next(self):
+        SimulateCall(ARGS.latency_ms)
+
+
+class FakeChromecast:
+
+    def __init__(self, host: str):
+        SimulateCall(ARGS.connect_ms)
+        self.host = host
+        self.device = FakeDeviceStatus(host)
+        self.status = FakeCastStatus()
+        self.media_controller = FakeMediaController()
+        self.socket_client = argparse.Namespace(is_connected=True)
+        self.listeners = []
+
+    def wait(self, timeout=None):
+        pass
+
+    def register_handler(self, handler):
+        pass
+
+    def register_status_listener(self, listener):
+        self.listeners.append(listener)
+
+    def register_launch_error_listener(self, listener):
+        pass
+
+    def register_connection_listener(self, listener):
+        pass
+
+    def quit_app(self):
+        SimulateCall(ARGS.latency_ms)
+
+    def set_volume(self, level):
+        SimulateCall(ARGS.latency_ms)
+        self.status.volume_level = level
+        for listener in self.listeners:
+            listener.new_cast_status(self.status)
+
+    def disconnect(self, blocking=True):
+        self.socket_client.is_connected = False
+
+
+# hosts of the simulated devices
+FLEET: List[str] = []
+
+
+# host -> friendly name of the simulated devices (default "Speaker NNNN")
+NAMES: Dict[str, str] = {}
+
+
+def FakeDeviceStatus(host: str) -> DeviceStatus:
+    index = FLEET.index(host)
+    return DeviceStatus(NAMES.get(host, f"Speaker {index:04d}"), "Fake Cast",
+                        "bench", f"00000000-0000-0000-0000-{index:012d}", "audio")
+
+
+def FakeGetDeviceStatus(host: str, *args, **kwargs):
+    return FakeDeviceStatus(host)
+
+
+async def FakeProbeHost(host: str, port: int, timeout: float,
+                        semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        await asyncio.sleep(ARGS.probe_ms / 1000.0)
+        return host in FLEET
+
+
+class FakeResponse(io.BytesIO):
+
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.headers = FakeHeaders({"ETag": '"bench"'})
+
+
+class FakeHeaders(dict):
+
+    def get_content_type(self):
+        return "audio/mpeg"
+
+
+def FakeUrlopen(request, timeout=None):
+    time.sleep(ARGS.latency_ms / 1000.0)
+    lines = ["[playlist]"] + [f"File{i + 1}=http://media.invalid/song{i}.mp3"
+                              for i in range(ARGS.playlist_size)]
+    return FakeResponse(bytes("\n".join(lines), "utf-8"))
+
+
+def InstallFakes():
+    global BROKER
+    BROKER = FakeBroker()
+    mqtt2cast.mqtt.Client = FakeMqttClient
+    mqtt2cast.pychromecast.Chromecast = FakeChromecast
+    mqtt2cast.pychromecast.dial.get_device_status = FakeGetDeviceStatus
+    mqtt2cast._ProbeHost = FakeProbeHost
+    mqtt2cast.urllib.request.urlopen = FakeUrlopen
+
+
+############################################################
+# Scenarios
+# Each returns a dict which becomes part of the report.
+############################################################
+def Topic(target: str, action: str) -> str:
+    return f"{mqtt2cast.MESSAGE_PREFIX}action/{target}/{action}"
+
+
+def BridgeIdle() -> bool:
+    # commands still waiting in a queue or being executed
+    queued = sum(q["depth"] + q["running"]
+                 for q in mqtt2cast.COMMAND_DISPATCHER.Stats().values())
+    publisher = mqtt2cast.MQTT_CLIENT.publisher.Stats()
+    return queued + publisher["depth_high"] + publisher["depth_telemetry"] == 0
+
+
+def WaitForResults(sent: Dict[str, float]) -> bool:
+    """
+    Waits until there is a result for every command. Results can be lost
+    when the outbound mqtt queue overflows (--mqtt_queue_size), so this
+    also gives up once the bridge went idle without new results.
+    """
+    deadline = time.monotonic() + ARGS.timeout
+    received = -1
+    while time.monotonic() < deadline:
+        if BROKER.WaitFor(lambda: all(cid in BROKER.results for cid in sent), 1.0):
+            return True
+        count = len(BROKER.results)
+        if count == received and BridgeIdle():
+            return False
+        received = count
+    return False
+
+
+def SendCommands(commands) -> Dict[str, Any]:
+    """
+    Delivers (target, action, arg) commands with correlation ids and
+    waits for all the results
+    """
+    BROKER.Reset()
+    sent = {}
+    on_message = []
+    start = time.monotonic()
+    for n, (target, action, arg) in enumerate(commands):
+        cid = f"bench{n}"
+        sent[cid] = time.monotonic()
+        BROKER.Deliver(Topic(target, action), json.dumps({"id": cid, "arg": arg}))
+        on_message.append(time.monotonic() - sent[cid])
+    delivered = time.monotonic()
+    complete = WaitForResults(sent)
+    done = time.monotonic()
+    statuses = collections.Counter(r["status"] for _, r in BROKER.results.values())
+    latencies = [t - sent[cid] for cid, (t, r) in BROKER.results.items()
+                 if r["status"] in ("ok", "failed")]
+    return {"commands": len(sent),
+            "complete": complete,
+            "lost_results": len(sent) - len(BROKER.results),
+            "duration": round(done - start, 3),
+            "throughput": round(len(sent) / (done - start), 1),
+            "deliver_duration": round(delivered - start, 3),
+            "statuses": dict(statuses),
+            "on_message": Percentiles(on_message),
+            "latency": Percentiles(latencies)}
+
+
+def ScenarioDispatch() -> Dict[str, Any]:
+    """play_media of a single mp3 round robin over all devices"""
+    names = sorted(mqtt2cast.CAST_DEVICES.name_map)
+    return SendCommands([(names[n % len(names)], "play_media",
+                          f"http://media.invalid/track{n}.mp3")
+                         for n in range(ARGS.commands)])
+
+
+def ScenarioBroadcast() -> Dict[str, Any]:
+    """play_media to all devices"""
+    out = SendCommands([("", "play_media", f"http://media.invalid/all{n}.mp3")
+                        for n in range(ARGS.broadcasts)])
+    outcomes = BROKER.broadcasts["play_media"]
+    out["devices"] = len(mqtt2cast.CAST_DEVICES.host_map)
+    out["fanout_duration"] = Percentiles([o["duration"] for o in outcomes])
+    out["device_latency"] = Percentiles(
+        [d["latency"] for o in outcomes for d in o["devices"].values() if d["ok"]])
+    out["device_failures"] = sum(o["failed"] for o in outcomes)
+    return out
+
+
+def ScenarioPlaylist() -> Dict[str, Any]:
+    """play_media of a .pls playlist, the first fetch misses the cache"""
+    names = sorted(mqtt2cast.CAST_DEVICES.name_map)
+    commands = [(names[n % len(names)], "play_media",
+                 f"http://media.invalid/list{n % 4}.pls")
+                for n in range(len(names))]
+    out = SendCommands(commands)
+    out["playlist_size"] = ARGS.playlist_size
+    out["playlist_cache"] = mqtt2cast.PLAYLIST_CACHE.Stats()
+    out["resolve"] = Percentiles(
+        [r["timing"].get("resolve", 0.0) for _, r in BROKER.results.values()])
+    return out
+
+
+def ScenarioVolumeStorm() -> Dict[str, Any]:
+    """many set_volume per device as sent by a volume slider"""
+    names = sorted(mqtt2cast.CAST_DEVICES.name_map)
+    commands = [(name, "set_volume", str(step / ARGS.volume_steps))
+                for step in range(ARGS.volume_steps) for name in names]
+    out = SendCommands(commands)
+    last = {}
+    for n, (name, _, _) in enumerate(commands):
+        last[name] = f"bench{n}"
+    out["final_value_latency"] = Percentiles(
+        [BROKER.results[cid][1]["timing"].get("total", 0.0)
+         for cid in last.values() if cid in BROKER.results])
+    return out
+
+
+def ScenarioSync() -> Dict[str, Any]:
+    """play_media_sync to a group defined via mqtt"""
+    names = sorted(mqtt2cast.CAST_DEVICES.name_map)[:ARGS.sync_size]
+    BROKER.Deliver(f"{mqtt2cast.MESSAGE_PREFIX}group/bench", ",".join(names))
+    out = SendCommands([("bench", "play_media_sync", f"http://media.invalid/sync{n}.mp3")
+                        for n in range(ARGS.syncs)])
+    out["members"] = len(names)
+    out["skew"] = Percentiles([r["skew"] for r in BROKER.syncs if r["skew"] is not None])
+    out["prepare"] = Percentiles([m["prepare"] for r in BROKER.syncs
+                                  for m in r["members"].values()])
+    out["not_started"] = sum(r["prepared"] - r["started"] for r in BROKER.syncs)
+    return out
+
+
+def ScenarioGetCasts() -> Dict[str, Any]:
+    """device lookups by ip, name, pattern and for all devices"""
+    devices = mqtt2cast.CAST_DEVICES
+    name = sorted(devices.name_map)[-1]
+    rounds = 2000
+    out = {}
+    for kind, host in [("ip", FLEET[-1]), ("name", name),
+                       ("pattern", "Speaker 00*"), ("all", "")]:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            devices.GetCasts(host)
+        out[kind] = round((time.perf_counter() - start) / rounds * 1e6, 3)
+    out["unit"] = "us/lookup"
+    return out
+
+
+def ScenarioDiscovery() -> Dict[str, Any]:
+    """subnet scan of ARGS.subnet with the simulated devices spread over it"""
+    manager = mqtt2cast.CastDeviceManager()
+    start = time.monotonic()
+    manager.ScanSubnets([ARGS.subnet])
+    duration = time.monotonic() - start
+    out = dict(manager.last_scan)
+    out["found"] = len(manager.host_map)
+    out["duration"] = round(duration, 3)
+    for host in list(manager.host_map):
+        manager._UnregisterCastDevice(host)
+    return out
+
+
+SCENARIOS = collections.OrderedDict([
+    ("get_casts", ScenarioGetCasts),
+    ("dispatch", ScenarioDispatch),
+    ("broadcast", ScenarioBroadcast),
+    ("playlist", ScenarioPlaylist),
+    ("volume_storm", ScenarioVolumeStorm),
+    ("sync", ScenarioSync),
+    ("discovery", ScenarioDiscovery),
+])
+
+
+############################################################
+# Replay
+# Feeds a recording of mqtt2cast.py --record back in, keeping
+# the recorded timing (scaled by --speed).
+############################################################
+class RecordedStatus(argparse.Namespace):
+    """A recorded status object, attributes which were not recorded are None"""
+
+    def __getattr__(self, name):
+        return None
+
+
+def ReadRecording(path: str) -> List[List[Any]]:
+    records = []
+    with open(path) as fp:
+        for line in fp:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # most likely the last line of a recording still being written
+                logging.warning(f"skipping bad line: {line[:80]}")
+    return records
+
+
+def ReplayStatus(cast: mqtt2cast.CastDeviceWrapper, kind: str, data: Dict[str, Any]):
+    if kind == "media_status":
+        cast.new_media_status(RecordedStatus(**data))
+    elif kind == "cast_status":
+        cast.new_cast_status(RecordedStatus(**data))
+    elif kind != "connection_status":
+        # a replayed connection loss would trigger a reconnect
+        cast.EmitMessage(kind, data)
+
+
+def Replay(records: List[List[Any]]) -> Dict[str, Any]:
+    """
+    Recorded action messages get a correlation id so their latency can
+    be measured, everything else is delivered as recorded
+    """
+    BROKER.Reset()
+    prefix = mqtt2cast.MESSAGE_PREFIX
+    devices = mqtt2cast.CAST_DEVICES
+    sent: Dict[str, float] = {}
+    actions: Dict[str, str] = {}
+    lag = []
+    # [seconds since start, commands queued, outbound mqtt messages queued]
+    samples: List[List[float]] = []
+    stop = threading.Event()
+    start = time.monotonic()
+
+    def sample():
+        while not stop.wait(ARGS.sample_interval):
+            queued = sum(q["depth"] for q in mqtt2cast.COMMAND_DISPATCHER.Stats().values())
+            publisher = mqtt2cast.MQTT_CLIENT.publisher.Stats()
+            samples.append([round(time.monotonic() - start, 3), queued,
+                            publisher["depth_high"] + publisher["depth_telemetry"]])
+    threading.Thread(target=sample, name="sampler", daemon=True).start()
+
+    kinds: collections.Counter = collections.Counter()
+    first = records[0][0] if records else 0.0
+    for n, record in enumerate(records):
+        if ARGS.speed > 0:
+            delay = start + (record[0] - first) / ARGS.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lag.append(-delay)
+        kinds[record[1]] += 1
+        if record[1] == "mqtt":
+            _, _, topic, payload = record
+            segments = topic[len(prefix):].split("/")
+            if segments[0] == "action" and len(segments) == 3:
+                cmd = mqtt2cast.ParseCommand(segments[1], segments[2], payload)
+                cid = f"replay{n}"
+                payload = json.dumps({"id": cid, "arg": cmd.payload})
+                sent[cid] = time.monotonic()
+                actions[cid] = cmd.action
+            BROKER.Deliver(topic, payload)
+        elif record[1] == "status":
+            _, _, host, name, kind, data = record
+            cast = devices.host_map.get(host)
+            if cast:
+                ReplayStatus(cast, kind, data)
+    delivered = time.monotonic()
+    complete = WaitForResults(sent)
+    done = time.monotonic()
+    stop.set()
+
+    by_action = collections.defaultdict(list)
+    for cid, (t, result) in list(BROKER.results.items()):
+        if cid in sent and result["status"] in ("ok", "failed"):
+            by_action[actions[cid]].append(t - sent[cid])
+    # keep the report small
+    step = max(1, len(samples) // 200)
+    return {"records": len(records),
+            "kinds": dict(kinds),
+            "commands": len(sent),
+            "complete": complete,
+            "speed": ARGS.speed,
+            "recorded_duration": round(records[-1][0] - first, 3) if records else 0.0,
+            "replay_duration": round(delivered - start, 3),
+            "drain_duration": round(done - delivered, 3),
+            "schedule_lag": Percentiles(lag),
+            "statuses": dict(collections.Counter(
+                r["status"] for cid, (_, r) in BROKER.results.items() if cid in sent)),
+            "latency": Percentiles([v for values in by_action.values() for v in values]),
+            "latency_by_action": {a: Percentiles(v) for a, v in sorted(by_action.items())},
+            "max_commands_queued": max((s[1] for s in samples), default=0),
+            "max_mqtt_queued": max((s[2] for s in samples), default=0),
+            "queue_samples": samples[::step]}
+
+
+def main():
+    global ARGS, FLEET
+    ARGS = PARSER.parse_args()
+    logging.basicConfig(level=logging.INFO if ARGS.verbose else logging.ERROR)
+    RANDOM.seed(ARGS.seed)
+    InstallFakes()
+
+    records = []
+    if ARGS.replay:
+        # the fleet are the devices seen in the recording
+        records = ReadRecording(ARGS.replay)
+        for record in records:
+            if record[1] == "status" and record[2] not in NAMES:
+                NAMES[record[2]] = record[3]
+                FLEET.append(record[2])
+    else:
+        hosts = [h.compressed for h in ipaddress.ip_network(ARGS.subnet)]
+        step = max(1, len(hosts) // ARGS.devices)
+        FLEET = hosts[::step][:ARGS.devices]
+
+    bridge_args = mqtt2cast.PARSER.parse_args(
+        [f"--scan_subnets={ARGS.subnet}"] + ARGS.bridge_args)
+    # the devices are registered directly, the subnet scan is its own scenario
+    bridge_args.scan_subnets = []
+    mqtt2cast.Start(bridge_args, "mqtt2cast-bench")
+    start = time.monotonic()
+    with mqtt2cast.concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
+        executor.map(mqtt2cast.CAST_DEVICES._RegisterCastDevice, FLEET)
+    registration = time.monotonic() - start
+    bridge_args.scan_subnets = [ARGS.subnet]
+
+    report = {"config": {k: v for k, v in vars(ARGS).items() if k != "report"},
+              "python": platform.python_version(),
+              "registration_duration": round(registration, 3),
+              "scenarios": {}}
+    if ARGS.replay:
+        print(f"replaying {len(records)} records", file=sys.stderr)
+        report["replay"] = Replay(records)
+    for name, scenario in SCENARIOS.items():
+        if ARGS.replay or (ARGS.scenario and name not in ARGS.scenario):
+            continue
+        print(f"running {name}", file=sys.stderr)
+        report["scenarios"][name] = scenario()
+    report["stats"] = mqtt2cast.CollectStats()
+    report["published"] = dict(BROKER.topics)
+
+    text = json.dumps(report, indent=1, default=str)
+    if ARGS.report:
+        with open(ARGS.report, "w") as fp:
+            fp.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
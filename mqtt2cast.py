@@ -4,18 +4,29 @@ Simple MQTT to Google Cast Bridge
 
 TODO: cyclic dependencied
 """
-from typing import List, Dict, Optional, Any, Tuple
+from typing import List, Dict, NamedTuple, Optional, Any, Set, Tuple
 
 import argparse
+import asyncio
 import functools
 import http.server
 import inspect
 import json
 import logging
+import os
+import collections
+import contextlib
 import concurrent.futures
+import fnmatch
+import hashlib
 import threading
 import time
 import platform
+import queue
+import sys
+import traceback
+import types
+import urllib.error
 import urllib.request
 import zeroconf
 import ipaddress
@@ -33,34 +44,116 @@ MESSAGE_PREFIX = f"mqtt2cast/"
 PARSER = argparse.ArgumentParser(description="mqtt2cast")
 PARSER.add_argument("--mqtt_broker", default="192.168.1.1")
 PARSER.add_argument("--mqtt_port", type=int, default=1883)
+PARSER.add_argument("--mqtt_queue_size", type=int, default=1000,
+                    help="max number of outbound mqtt messages buffered (e.g. while the broker is down)")
+PARSER.add_argument("--mqtt_max_inflight", type=int, default=20,
+                    help="max number of outbound mqtt messages handed to the broker connection at once")
+PARSER.add_argument("--bench_router", action="store_true", default=False,
+                    help="run a micro benchmark of the mqtt topic routing and exit")
 PARSER.add_argument("--dryrun", action="store_true", default=False)
 PARSER.add_argument("--verbose", action="store_true", default=False)
 PARSER.add_argument("--debug", action="store_true", default=False)
 PARSER.add_argument("--use_zeroconf", action="store_true", default=False)
 PARSER.add_argument("--scan_subnets", action='append',
                     help="scan this subnet (e.g. '192.168.1.0/24') potentially beside using zeroconf")
+PARSER.add_argument("--group", action='append',
+                    help="define a device group usable as target, e.g. 'downstairs=Kitchen,Living Room,192.168.1.7'")
+PARSER.add_argument("--probe_concurrency", type=int, default=256,
+                    help="max number of concurrent connection attempts when scanning subnets")
+PARSER.add_argument("--probe_timeout", type=float, default=0.5,
+                    help="connect timeout (seconds) for each host when scanning subnets")
+PARSER.add_argument("--device_cache", default="",
+                    help="file used to remember known devices across restarts (e.g. ~/.mqtt2cast.json)")
+PARSER.add_argument("--lazy_connections", action="store_true", default=False,
+                    help="only connect to devices when they receive a command (large fleets)")
+PARSER.add_argument("--max_connections", type=int, default=32,
+                    help="with --lazy_connections max number of open unpinned connections")
+PARSER.add_argument("--connection_idle_timeout", type=float, default=300.0,
+                    help="with --lazy_connections close connections idle for this many seconds (0 = never)")
+PARSER.add_argument("--pin", action="append",
+                    help="with --lazy_connections keep this device (ip, name or pattern) connected")
+PARSER.add_argument("--queue_window", type=int, default=20,
+                    help="max number of playlist items loaded onto a device at once")
+PARSER.add_argument("--queue_refill", type=int, default=5,
+                    help="append more playlist items when fewer than this are left on the device")
+PARSER.add_argument("--playlist_cache_size", type=int, default=128,
+                    help="max number of playlists and media types kept in memory")
+PARSER.add_argument("--playlist_cache_ttl", type=float, default=3600,
+                    help="seconds before a cached playlist is revalidated with the server")
+PARSER.add_argument("--playlist_cache_dir", default="",
+                    help="directory for persisting fetched playlists across restarts "
+                    "(at most --playlist_cache_size files)")
+PARSER.add_argument("--event_min_interval", type=float, default=0.0,
+                    help="publish each device event topic at most once per this many seconds")
+PARSER.add_argument("--event_delta", action="store_true", default=False,
+                    help="also publish the fields that changed on <event topic>/delta")
+PARSER.add_argument("--history_size", type=int, default=500,
+                    help="number of events remembered per device for /api/history")
+PARSER.add_argument("--sse_buffer", type=int, default=100,
+                    help="max number of events buffered per /events client before it is disconnected")
 PARSER.add_argument("--host", default="",
                     help="hostname to use for debug webserver")
 PARSER.add_argument("--port", type=int, default=7777,
                     help="port to use for debug webserver")
+PARSER.add_argument("--worker_queue_size", type=int, default=100,
+                    help="max number of pending commands per device")
+PARSER.add_argument("--queue_wait_warning", type=float, default=1.0,
+                    help="warn when a command waited longer than this (seconds) in its queue")
+PARSER.add_argument("--coalesce_window_ms", type=float, default=0,
+                    help="delay set_volume/load_url/queue_next by this much so newer commands can replace them")
+PARSER.add_argument("--hold_unknown", type=float, default=30.0,
+                    help="while discovery is running park commands for unknown devices up to this many seconds")
+PARSER.add_argument("--broadcast_timeout", type=float, default=10.0,
+                    help="per device timeout (seconds) for commands sent to several devices")
+PARSER.add_argument("--cluster_node", default="",
+                    help="enables cluster mode: unique name of this instance, devices are split between all instances on the broker")
+PARSER.add_argument("--cluster_heartbeat", type=float, default=10.0,
+                    help="seconds between cluster heartbeats, nodes silent for 3 heartbeats are considered gone")
+PARSER.add_argument("--debug_endpoints", action="store_true", default=False,
+                    help="serve /debug/threads, /debug/profile and /debug/slow")
+PARSER.add_argument("--slow_command_ms", type=float, default=0.0,
+                    help="log commands taking longer than this (0 = off)")
+PARSER.add_argument("--record", default="",
+                    help="append all inbound mqtt messages and device status updates to this file (see bench_mqtt2cast.py --replay)")
+PARSER.add_argument("--sync_timeout", type=float, default=15.0,
+                    help="max seconds play_media_sync waits for devices to buffer the media")
 
 GOOGLE_CAST_IDENTIFIER = "_googlecast._tcp.local."
-
-ARGS = PARSER.parse_args()
-
-if ARGS.verbose:
-    logging.basicConfig(level=logging.INFO)
-
-if ARGS.debug:
-    logging.basicConfig(level=logging.DEBUG)
-
-if not ARGS.use_zeroconf and not ARGS.scan_subnets:
-    print("you must specify either --use_zeroconf or at least one --scan_subnets=...")
-    quit(1)
+GOOGLE_CAST_PORT = 8009
+MQTT_QOS = 1
+# time we give zeroconf to report devices before dropping stale cache entries
+ZEROCONF_SETTLE_TIME = 10.0
+# backoff for reconnecting devices which lost their connection
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+RECONNECT_MAX_ATTEMPTS = 8
+# only the latest pending command of these kinds is executed
+COALESCED_ACTIONS = {"set_volume", "load_url", "queue_next"}
+# queue for all commands which do not target a single known device
+SHARED_QUEUE = "*"
+# delay for heartbeats sent early because the devices of a node changed
+CLUSTER_ANNOUNCE_DELAY = 1.0
+# workers without commands for this long are shut down
+WORKER_IDLE_TIMEOUT = 300.0
+# the device cache file is written at most this often
+DEVICE_CACHE_SAVE_DELAY = 5.0
+
+# the defaults - main() parses the actual command line
+ARGS = PARSER.parse_args([])
 
 # sadly we have a circular dependency between these two globals:
 CAST_DEVICES: Optional["CastDeviceManager"] = None
 MQTT_CLIENT: Optional["MqttClient"] = None
+COMMAND_DISPATCHER: Optional["CommandDispatcher"] = None
+PLAYLIST_CACHE: Optional["TtlCache"] = None
+MIME_TYPE_CACHE: Optional["TtlCache"] = None
+EVENT_PUBLISHER: Optional["EventPublisher"] = None
+EVENT_STREAM: Optional["EventStream"] = None
+HISTORY_STORE: Optional["HistoryStore"] = None
+STARTUP: Optional["StartupTracker"] = None
+CLUSTER: Optional["Cluster"] = None
+RECORDER: Optional["Recorder"] = None
+WEB_SERVER: Optional[http.server.ThreadingHTTPServer] = None
 
 
 ############################################################
@@ -113,11 +206,291 @@ def StrippedObject(obj):
     return out
 
 
+SERIALIZERS: Dict[type, Any] = {}
+
+
+def _MakeSerializer(sample):
+    cls = type(sample)
+    if isinstance(sample, dict):
+        return dict
+    if hasattr(cls, "_fields"):
+        fields = cls._fields
+        return lambda obj: dict(zip(fields, obj))
+    if hasattr(sample, "__dict__"):
+        return lambda obj: dict(vars(obj))
+    slots = [s for c in cls.__mro__ for s in getattr(c, "__slots__", [])]
+    if slots:
+        return lambda obj: {s: getattr(obj, s, None) for s in slots}
+    return lambda obj: {"payload": str(obj)}
+
+
+def SerializeObject(obj) -> Dict[str, Any]:
+    """
+    Like ObjToDict but returns a snapshot (copy) and caches the
+    field extraction logic per type
+    """
+    cls = type(obj)
+    serializer = SERIALIZERS.get(cls)
+    if serializer is None:
+        serializer = _MakeSerializer(obj)
+        SERIALIZERS[cls] = serializer
+    return serializer(obj)
+
+
 class ComplexEncoder(json.JSONEncoder):
     def default(self, obj):
         return str(obj)
 
 
+############################################################
+# Metrics
+# Prometheus text format served on /metrics. Updating a metric
+# is a dict update under a lock so it is cheap enough for hot paths.
+############################################################
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _FormatLabels(labels: Labels, extra: str = "") -> str:
+    parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    """
+    Minimal registry for labeled counters and histograms. Gauges are
+    produced at scrape time by the registered collectors.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help: Dict[str, Tuple[str, str]] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        # (name, labels) -> [count per bucket..., count, sum]
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self.collectors: List[Any] = []
+
+    def Describe(self, name: str, kind: str, help: str):
+        self.help[name] = (kind, help)
+
+    def Inc(self, name: str, labels: Labels = (), value: float = 1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def Observe(self, name: str, labels: Labels, value: float):
+        key = (name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = [0] * (len(LATENCY_BUCKETS) + 2)
+                self.histograms[key] = h
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+                    break
+            h[-2] += 1
+            h[-1] += value
+
+    def AddCollector(self, collector):
+        """collector() returns a list of (name, labels, value) gauge samples"""
+        self.collectors.append(collector)
+
+    def Render(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v)) for k, v in self.histograms.items())
+        gauges = []
+        for collector in self.collectors:
+            try:
+                gauges += collector()
+            except Exception as err:
+                logging.error(f"metrics collector failed: {err}")
+        out = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self.help:
+                described.add(name)
+                kind, help = self.help[name]
+                out.append(f"# HELP {name} {help}")
+                out.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name)
+            out.append(f"{name}{_FormatLabels(labels)} {value}")
+        for (name, labels), h in histograms:
+            header(name)
+            cumulative: float = 0
+            for bound, count in zip(LATENCY_BUCKETS, h):
+                cumulative += count
+                le = 'le="%s"' % bound
+                out.append(f"{name}_bucket{_FormatLabels(labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            out.append(f"{name}_bucket{_FormatLabels(labels, le)} {h[-2]}")
+            out.append(f"{name}_count{_FormatLabels(labels)} {h[-2]}")
+            out.append(f"{name}_sum{_FormatLabels(labels)} {h[-1]}")
+        for name, labels, value in sorted(gauges, key=lambda g: (g[0], g[1])):
+            header(name)
+            out.append(f"{name}{_FormatLabels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+METRICS.Describe("mqtt2cast_command_duration_seconds", "histogram",
+                 "Execution time of commands by action and queue (device ip or *)")
+METRICS.Describe("mqtt2cast_command_queue_seconds", "histogram",
+                 "Time commands waited in their device queue")
+METRICS.Describe("mqtt2cast_commands_total", "counter",
+                 "Executed commands by action and result")
+METRICS.Describe("mqtt2cast_cast_call_duration_seconds", "histogram",
+                 "Duration of calls to a cast device by method and device")
+METRICS.Describe("mqtt2cast_cast_call_errors_total", "counter",
+                 "Failed calls to a cast device by method and device")
+METRICS.Describe("mqtt2cast_discovery_duration_seconds", "histogram",
+                 "Duration of subnet scans")
+METRICS.Describe("mqtt2cast_registrations_total", "counter",
+                 "Device registration attempts by result")
+METRICS.Describe("mqtt2cast_mqtt_received_total", "counter",
+                 "MQTT messages received")
+METRICS.Describe("mqtt2cast_mqtt_published_total", "counter",
+                 "MQTT messages handed to the broker connection")
+METRICS.Describe("mqtt2cast_mqtt_outbound_queue_depth", "gauge",
+                 "Outbound MQTT messages waiting by priority")
+METRICS.Describe("mqtt2cast_command_queue_depth", "gauge",
+                 "Commands waiting per device queue")
+METRICS.Describe("mqtt2cast_device_connected", "gauge",
+                 "1 if the connection to the cast device is up")
+METRICS.Describe("mqtt2cast_connect_duration_seconds", "histogram",
+                 "Time to open a connection to a cast device on demand")
+METRICS.Describe("mqtt2cast_connection_pool_size", "gauge",
+                 "Open cast connections (--lazy_connections) by pinned state")
+
+
+############################################################
+# Traffic Recording
+# --record appends one compact json line per inbound mqtt
+# message and per device status callback:
+# [time, "mqtt", topic, payload]
+# [time, "status", host, name, kind, data]
+############################################################
+class Recorder:
+    """
+    The lines are written by a background thread so recording
+    does not slow down the callbacks
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.written = 0
+        threading.Thread(target=self._Run, name="recorder", daemon=True).start()
+
+    def Record(self, *record):
+        self.queue.put((round(time.time(), 3),) + record)
+
+    @exception
+    def _Run(self):
+        with open(self.path, "a") as fp:
+            while True:
+                record = self.queue.get()
+                fp.write(json.dumps(record, cls=ComplexEncoder, separators=(",", ":")) + "\n")
+                self.written += 1
+                if self.queue.empty():
+                    fp.flush()
+
+    def Stats(self) -> Dict[str, Any]:
+        return {"path": self.path,
+                "written": self.written,
+                "pending": self.queue.qsize()}
+
+
+############################################################
+# Command Timing
+# Breaks the execution time of a command down into phases
+# (queue, resolve, send, active) for the result message.
+############################################################
+COMMAND_CONTEXT = threading.local()
+
+
+class CommandTiming:
+    """
+    Accumulates the exclusive time spent in each phase. Phases can be
+    entered from several threads (fan-out), the report uses the slowest
+    thread for each phase.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # phase -> thread ident -> seconds
+        self.phases: Dict[str, Dict[int, float]] = {}
+        self.errors: List[str] = []
+
+    def Add(self, phase: str, seconds: float):
+        ident = threading.get_ident()
+        with self.lock:
+            per_thread = self.phases.setdefault(phase, {})
+            per_thread[ident] = per_thread.get(ident, 0.0) + seconds
+
+    def Report(self) -> Dict[str, float]:
+        with self.lock:
+            return {phase: round(max(per_thread.values()), 4)
+                    for phase, per_thread in self.phases.items()}
+
+
+@contextlib.contextmanager
+def TimingPhase(phase: str):
+    """
+    Records the time spent in the block for the command executed by
+    the current thread. Time spent in nested phases is only counted
+    for the nested phase.
+    """
+    timing = getattr(COMMAND_CONTEXT, "timing", None)
+    if timing is None:
+        yield
+        return
+    stack = COMMAND_CONTEXT.__dict__.setdefault("stack", [])
+    frame = [time.monotonic(), 0.0]
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        duration = time.monotonic() - frame[0]
+        timing.Add(phase, duration - frame[1])
+        if stack:
+            stack[-1][1] += duration
+
+
+def timed(method: str):
+    """
+    A decorator for CastDeviceWrapper methods recording their
+    duration and failures in METRICS and as "send" phase of the
+    current command
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            start = time.monotonic()
+            labels = (("method", method), ("device", self.name))
+            try:
+                with TimingPhase("send"), self.Connection():
+                    return function(self, *args, **kwargs)
+            except Exception:
+                METRICS.Inc("mqtt2cast_cast_call_errors_total", labels)
+                raise
+            finally:
+                METRICS.Observe("mqtt2cast_cast_call_duration_seconds", labels,
+                                time.monotonic() - start)
+        return wrapper
+    return decorator
+
+
 ############################################################
 # Status Page
 ############################################################
@@ -141,15 +514,216 @@ HTML_EPILOG = """
 </html>
 """
 
+# keeps the history table up to date using the /events stream
+STATUS_PAGE_SCRIPT = """
+<script>
+const historyTable = document.getElementById("history");
+const events = new EventSource("/events");
+events.onmessage = function(msg) {
+  const ev = JSON.parse(msg.data);
+  let row = document.getElementById(ev.host + "|" + ev.kind);
+  if (!row) {
+    let header = document.getElementById("host|" + ev.host);
+    if (!header) {
+      header = historyTable.insertRow(-1);
+      header.id = "host|" + ev.host;
+      const th = document.createElement("th");
+      th.colSpan = 3;
+      th.textContent = ev.host;
+      header.appendChild(th);
+    }
+    let last = header;
+    while (last.nextElementSibling && last.nextElementSibling.dataset.host === ev.host) {
+      last = last.nextElementSibling;
+    }
+    row = historyTable.insertRow(last.rowIndex + 1);
+    row.id = ev.host + "|" + ev.kind;
+    row.dataset.host = ev.host;
+    for (let i = 0; i < 3; ++i) {
+      const cell = row.insertCell(-1);
+      if (i > 0) cell.appendChild(document.createElement("pre"));
+    }
+    row.cells[0].textContent = ev.kind;
+  }
+  row.cells[1].firstChild.textContent = ev.time;
+  row.cells[2].firstChild.textContent = ev.content;
+};
+</script>
+"""
+
 
 HISTORY_LOG: Dict[Tuple[Any, Any], Any] = {}
+# bumped on every change of HISTORY_LOG - used to invalidate STATUS_CACHE
+HISTORY_GENERATION = 0
+
+
+def HistoryContent(data: Any) -> str:
+    content = [str(type(data))]
+    for k, v in sorted(PruneDict(ObjToDict(data)).items()):
+        content.append("%s: %s" % (k, repr(v)))
+    return "\n".join(content)
+
+
+class SseClient:
+    __slots__ = ["queue", "dropped"]
+
+    def __init__(self, buffer_size: int):
+        self.queue: queue.Queue = queue.Queue(buffer_size)
+        # set when the client could not keep up
+        self.dropped = False
+
+
+class EventStream:
+    """
+    Pushes history events to the clients of the /events endpoint
+    (Server-Sent Events). Every client has a bounded buffer, clients
+    which fall behind are disconnected.
+    """
+
+    def __init__(self, buffer_size: int):
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.clients: List[SseClient] = []
+        self.sent = 0
+        self.slow_clients = 0
+
+    def Connect(self) -> SseClient:
+        client = SseClient(self.buffer_size)
+        with self.lock:
+            self.clients.append(client)
+        return client
+
+    def Disconnect(self, client: SseClient):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def Publish(self, event: Dict[str, Any]):
+        if not self.clients:
+            return
+        data = json.dumps(event, cls=ComplexEncoder)
+        with self.lock:
+            for client in list(self.clients):
+                try:
+                    client.queue.put_nowait(data)
+                    self.sent += 1
+                except queue.Full:
+                    client.dropped = True
+                    self.clients.remove(client)
+                    self.slow_clients += 1
+
+    def Stats(self) -> Dict[str, int]:
+        return {"clients": len(self.clients),
+                "sent": self.sent,
+                "slow_clients": self.slow_clients}
+
+
+class HistoryRecord:
+    __slots__ = ["time", "kind", "payload"]
+
+    def __init__(self, time: float, kind: str, payload: str):
+        # time.monotonic() of the event
+        self.time = time
+        self.kind = kind
+        # json snapshot of the event data taken when the event happened
+        self.payload = payload
+
+
+# sys.getsizeof() of a HistoryRecord plus the list slot referencing it
+HISTORY_RECORD_OVERHEAD = 64
+# converts time.monotonic() to time.time()
+MONOTONIC_TO_WALL = time.time() - time.monotonic()
+
+
+class DeviceHistory:
+    """
+    Fixed capacity ring buffer of HistoryRecords for a single device
+    """
+
+    def __init__(self, capacity: int):
+        self.records: List[Optional[HistoryRecord]] = [None] * capacity
+        self.next = 0
+        self.size = 0
+        self.bytes = 0
+
+    def Append(self, record: HistoryRecord):
+        old = self.records[self.next]
+        if old is not None:
+            self.bytes -= len(old.payload) + HISTORY_RECORD_OVERHEAD
+        self.records[self.next] = record
+        self.bytes += len(record.payload) + HISTORY_RECORD_OVERHEAD
+        self.next = (self.next + 1) % len(self.records)
+        self.size = min(self.size + 1, len(self.records))
+
+    def Query(self, since: float, kind: str) -> List[HistoryRecord]:
+        """Returns the matching records, oldest first"""
+        capacity = len(self.records)
+        start = (self.next - self.size) % capacity
+        out = []
+        for i in range(self.size):
+            record = self.records[(start + i) % capacity]
+            if record is None:
+                continue
+            if record.time >= since and (not kind or record.kind == kind):
+                out.append(record)
+        return out
+
+
+class HistoryStore:
+    """
+    Keeps the last `capacity` events of every device - unlike HISTORY_LOG
+    which only has the latest event of each kind.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.devices: Dict[str, DeviceHistory] = {}
+
+    def Add(self, host: str, kind: str, data: Any):
+        record = HistoryRecord(time.monotonic(), kind,
+                               json.dumps(SerializeObject(data), cls=ComplexEncoder))
+        with self.lock:
+            history = self.devices.get(host)
+            if history is None:
+                history = DeviceHistory(self.capacity)
+                self.devices[host] = history
+            history.Append(record)
+
+    def QueryJson(self, hosts: List[str], since: float, kind: str) -> str:
+        """since is in seconds since the epoch"""
+        since -= MONOTONIC_TO_WALL
+        with self.lock:
+            records = [(record, host) for host in hosts if host in self.devices
+                       for record in self.devices[host].Query(since, kind)]
+        records.sort(key=lambda x: x[0].time)
+        out = ['{"host": %s, "time": %.3f, "kind": %s, "payload": %s}' % (
+            json.dumps(host), r.time + MONOTONIC_TO_WALL, json.dumps(r.kind), r.payload)
+            for r, host in records]
+        return '{"records": [' + ",\n".join(out) + "]}"
+
+    def Stats(self) -> Dict[str, int]:
+        with self.lock:
+            histories = list(self.devices.values())
+        return {"devices": len(histories),
+                "capacity_per_device": self.capacity,
+                "records": sum(h.size for h in histories),
+                "bytes": sum(h.bytes for h in histories)}
 
 
 def LogHistory(host: str, kind: str, data: Any):
-    global HISTORY_LOG
+    global HISTORY_LOG, HISTORY_GENERATION, EVENT_STREAM, HISTORY_STORE
     now = time.strftime("%y/%m/%d %H:%M:%S")
     logging.info(f"{host} {kind} {now}")
     HISTORY_LOG[(host, kind)] = (now, data)
+    HISTORY_GENERATION += 1
+    if HISTORY_STORE:
+        HISTORY_STORE.Add(host, kind, data)
+    if EVENT_STREAM and EVENT_STREAM.clients:
+        EVENT_STREAM.Publish({"host": host,
+                              "kind": kind,
+                              "time": now,
+                              "content": HistoryContent(data)})
 
 
 ############################################################
@@ -185,6 +759,153 @@ class UrlCastController(pychromecast.controllers.BaseController):
         self.send_message({"type": kind, "url": url})
 
 
+class EventPublisher:
+    """
+    Publishes the (retained) device events. Payloads identical to the
+    last one published on a topic are skipped and each topic is published
+    at most once per min_interval - the latest payload wins.
+    With delta=True the fields which changed are also sent (not retained)
+    on <topic>/delta, the topic itself always has the full retained state
+    for late subscribers.
+    """
+
+    def __init__(self, min_interval: float, delta: bool):
+        self.min_interval = min_interval
+        self.delta = delta
+        self.lock = threading.Lock()
+        self.last: Dict[str, Dict[str, Any]] = {}
+        self.last_time: Dict[str, float] = {}
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.published = 0
+        self.duplicates = 0
+        self.deferred = 0
+
+    def Publish(self, topic: str, fields: Dict[str, Any]):
+        with self.lock:
+            if self.last.get(topic) == fields:
+                self.duplicates += 1
+                # a deferred update is obsolete if we are back to the published state
+                self.pending.pop(topic, None)
+                return
+            wait = self.last_time.get(topic, 0.0) + self.min_interval - time.monotonic()
+            if wait > 0:
+                self.deferred += 1
+                if topic not in self.pending:
+                    timer = threading.Timer(wait, self._Flush, (topic,))
+                    timer.daemon = True
+                    timer.start()
+                self.pending[topic] = fields
+                return
+            old = self._Record(topic, fields)
+        self._Send(topic, fields, old)
+
+    @exception
+    def _Flush(self, topic: str):
+        with self.lock:
+            fields = self.pending.pop(topic, None)
+            if fields is None:
+                return
+            old = self._Record(topic, fields)
+        self._Send(topic, fields, old)
+
+    def _Record(self, topic, fields) -> Optional[Dict[str, Any]]:
+        old = self.last.get(topic)
+        self.last[topic] = fields
+        self.last_time[topic] = time.monotonic()
+        self.published += 1
+        return old
+
+    def _Send(self, topic: str, fields: Dict[str, Any], old: Optional[Dict[str, Any]]):
+        global MQTT_CLIENT
+        MQTT_CLIENT.EmitMessage(
+            topic, json.dumps(fields, cls=ComplexEncoder), telemetry=True)
+        if self.delta and old is not None:
+            changed = {k: v for k, v in fields.items() if old.get(k) != v}
+            changed.update({k: None for k in old if k not in fields})
+            MQTT_CLIENT.EmitMessage(
+                f"{topic}/delta", json.dumps(changed, cls=ComplexEncoder),
+                retain=False, telemetry=True)
+
+    def Stats(self) -> Dict[str, int]:
+        return {"published": self.published,
+                "duplicates": self.duplicates,
+                "deferred": self.deferred}
+
+
+def _QueueItem(url: str, mime_type: str, autoplay: bool = True) -> Dict[str, Any]:
+    return {"media": {"contentId": url,
+                      "contentType": mime_type,
+                      "streamType": "BUFFERED"},
+            "autoplay": autoplay,
+            "preloadTime": 10}
+
+
+CAST_STATE_FIELDS = ("volume_level", "volume_muted", "app_id", "display_name",
+                     "status_text", "is_stand_by")
+MEDIA_STATE_FIELDS = ("player_state", "content_id", "content_type", "title",
+                      "artist", "current_time", "duration", "idle_reason")
+
+
+class DeviceState:
+    """
+    Normalized snapshot of the cast and media status of a device,
+    maintained by the status callbacks and served without asking
+    the device (see mqtt2cast/query/... and /api/state).
+    Every field has the time it last changed and was last reported.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # field -> [value, changed, updated] (seconds since the epoch)
+        self.fields: Dict[str, List[Any]] = {}
+
+    def Update(self, status, fields):
+        now = time.time()
+        with self.lock:
+            for field in fields:
+                value = getattr(status, field, None)
+                entry = self.fields.get(field)
+                if entry is None or entry[0] != value:
+                    self.fields[field] = [value, now, now]
+                else:
+                    entry[2] = now
+
+    def Get(self, field: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.fields.get(field)
+            if entry is None:
+                return None
+            value, changed, updated = entry
+        return {"value": value,
+                "changed": changed,
+                "updated": updated,
+                "age": round(time.time() - updated, 3)}
+
+    def Snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            fields = list(self.fields)
+        out = {}
+        for field in fields:
+            entry = self.Get(field)
+            if entry is not None:
+                out[field] = entry
+        return out
+
+
+class ConnectionListener:
+    """
+    Connection status listener for one Chromecast object, so callbacks of
+    an old (detached) connection can be told apart from the current one
+    """
+
+    def __init__(self, device: "CastDeviceWrapper", cast):
+        self.device = device
+        self.cast = cast
+
+    def new_connection_status(self, status):
+        self.device.new_connection_status(status, self.cast)
+
+
 class CastDeviceWrapper(pychromecast.controllers.media.MediaStatusListener,
                         pychromecast.controllers.receiver.CastStatusListener):
     """
@@ -193,12 +914,55 @@ class CastDeviceWrapper(pychromecast.controllers.media.MediaStatusListener,
     The class also functions as a StatusListener and MediaStatusListener
     """
 
-    def __init__(self, host):
+    def __init__(self, host, lazy: bool = False):
         self.host = host
+        # playlist currently fed to the device queue (see PlayPlaylist)
+        self.lock = threading.Lock()
+        self.playlist: List[Tuple[str, str]] = []
+        self.playlist_loaded = 0
+        # pychromecast.Chromecast with the dashcast controller attached,
+        # None while not connected (see ConnectionPool)
+        self.cast: Any = None
+        # bookkeeping for the ConnectionPool (--lazy_connections)
+        self.connect_lock = threading.Lock()
+        self.pinned = False
+        self.busy = 0
+        # the connection was lost while busy, close it on release
+        self.drop_pending = False
+        self.last_used = 0.0
+        # fan-out call which outlived --broadcast_timeout (see RunOnCasts)
+        self.late_call: Optional[concurrent.futures.Future] = None
+        self.state = DeviceState()
+        # latest player state, see WaitForPlayerState
+        self.status_cond = threading.Condition()
+        self.player_state = ""
+        self.player_state_time = 0.0
+        self.player_position = 0.0
+        if not lazy:
+            self.Connect()
+            return
+        # only fetch the metadata, Connect() happens on first use
         # this may raise an exception
-        cast = pychromecast.Chromecast(host=host)
+        # renamed to get_device_info in newer pychromecast versions
+        get_status = (getattr(pychromecast.dial, "get_device_status", None) or
+                      pychromecast.dial.get_device_info)
+        status = get_status(host)
+        if status is None:
+            raise pychromecast.error.ChromecastConnectionError(
+                f"no device status from {host}")
+        self.name = status.friendly_name
+        self.uuid = str(status.uuid)
+        self.model = status.model_name
+        logging.info("found device: [%s] at %s", self.name, self.host)
+        LogHistory(self.host, "device_status", status)
+
+    def Connect(self):
+        # this may raise an exception
+        cast = pychromecast.Chromecast(host=self.host)
         cast.wait()
         self.name = cast.device.friendly_name
+        self.uuid = str(cast.device.uuid)
+        self.model = cast.device.model_name
         logging.info("found device: [%s] at %s", self.name, self.host)
         # cast.dashcast = UrlCastController()
         cast.dashcast = dashcast.DashCastController()
@@ -209,23 +973,65 @@ class CastDeviceWrapper(pychromecast.controllers.media.MediaStatusListener,
         cast.register_status_listener(self)
         cast.media_controller.register_status_listener(self)
         cast.register_launch_error_listener(self)
-        cast.register_connection_listener(self)
+        cast.register_connection_listener(ConnectionListener(self, cast))
         self.cast = cast
         mc = cast.media_controller
+        if cast.status:
+            self.state.Update(cast.status, CAST_STATE_FIELDS)
+        if mc.status:
+            self.state.Update(mc.status, MEDIA_STATE_FIELDS)
         LogHistory(self.host, "device_status", cast.device)
         LogHistory(self.host, "cast_status", cast.status)
         LogHistory(self.host, "media_status", mc.status)
 
+    def Detach(self) -> Optional[pychromecast.Chromecast]:
+        cast, self.cast = self.cast, None
+        return cast
+
+    def Disconnect(self):
+        cast = self.Detach()
+        if cast is None:
+            return
+        try:
+            cast.disconnect(blocking=False)
+        except Exception as err:
+            logging.warning(f"disconnect failed for {self.host}: {err}")
+
+    @contextlib.contextmanager
+    def Connection(self):
+        """Makes sure self.cast is connected while in use"""
+        global CAST_DEVICES
+        pool = CAST_DEVICES.pool if CAST_DEVICES else None
+        if pool is None:
+            yield
+            return
+        pool.Acquire(self)
+        try:
+            yield
+        finally:
+            pool.Release(self)
+
+    def IsConnected(self) -> bool:
+        cast = self.cast
+        return cast is not None and cast.socket_client.is_connected
+
+    def IsHealthy(self) -> bool:
+        # a lazy device without an open connection is fine
+        return self.cast is None or self.IsConnected()
+
     def EmitMessage(self, event, data):
-        global MQTT_CLIENT
-        MQTT_CLIENT.EmitMessage(
-            f"{MESSAGE_PREFIX}event/{self.name}/event/{event}",
-            json.dumps(ObjToDict(data), cls=ComplexEncoder))
+        global EVENT_PUBLISHER, RECORDER
+        serialized = SerializeObject(data)
+        if RECORDER:
+            RECORDER.Record("status", self.host, self.name, event, serialized)
+        EVENT_PUBLISHER.Publish(
+            f"{MESSAGE_PREFIX}event/{self.name}/event/{event}", serialized)
         LogHistory(self.host, event, data)
 
     # callback API for chrome cast
     @exception
     def new_cast_status(self, status):
+        self.state.Update(status, CAST_STATE_FIELDS)
         self.EmitMessage("cast_status", status)
 
     # callback API for chrome cast
@@ -236,25 +1042,148 @@ class CastDeviceWrapper(pychromecast.controllers.media.MediaStatusListener,
     # callback API for chrome cast
     @exception
     def new_media_status(self, status):
+        now = time.monotonic()
+        with self.status_cond:
+            self.player_state = status.player_state
+            self.player_state_time = now
+            self.player_position = status.current_time or 0.0
+            self.status_cond.notify_all()
+        self.state.Update(status, MEDIA_STATE_FIELDS)
         self.EmitMessage("media_status", status)
+        self._RefillQueue(status)
+
+    def WaitForPlayerState(self, states, since: float,
+                           timeout: float) -> Optional[Tuple[float, float]]:
+        """
+        Waits for a media status with one of the player states which
+        arrived after since. Returns its arrival time and media position.
+        """
+        def reached():
+            return (self.player_state in states and
+                    self.player_state_time >= since)
+        with self.status_cond:
+            if not self.status_cond.wait_for(reached, timeout):
+                return None
+            return self.player_state_time, self.player_position
+
+    # callback API for chrome cast (newer pychromecast versions)
+    @exception
+    def load_media_failed(self, queue_item_id, error_code):
+        self.EmitMessage("load_media_failed",
+                         {"queue_item_id": queue_item_id, "error_code": error_code})
 
     # callback API for chrome cast
     @exception
-    def new_connection_status(self, status):
+    def new_connection_status(self, status, source=None):
+        global CAST_DEVICES
+        if source is not None and source is not self.cast:
+            # a late callback of a connection we already closed
+            return
         self.EmitMessage("connection_status", status)
+        if status.status not in ("LOST", "FAILED") or not CAST_DEVICES:
+            return
+        if CAST_DEVICES.pool and not self.pinned:
+            # reconnects on next use
+            CAST_DEVICES.pool.Drop(self)
+        else:
+            CAST_DEVICES.ScheduleReconnect(self.host)
 
+    @timed("play_media")
     def PlayMedia(self, song_url: str, mime_type: str, enqueue: bool):
         mc = self.cast.media_controller
         LogHistory(self.host, "play_url", (song_url, mime_type, enqueue))
         mc.play_media(song_url, content_type=mime_type, enqueue=enqueue)
         if not enqueue:
-            mc.block_until_active()
-
+            with TimingPhase("active"):
+                mc.block_until_active()
+
+    @timed("play_playlist")
+    def PlayPlaylist(self, items: List[Tuple[str, str]]):
+        """
+        Loads a playlist of (url, mime_type) with a single QUEUE_LOAD.
+        Only a window of items is sent up front, _RefillQueue()
+        appends more when the device is running low.
+        """
+        LogHistory(self.host, "play_playlist", (items[0][0], len(items)))
+        self._LoadQueue(items, True)
+        with TimingPhase("active"):
+            self.cast.media_controller.block_until_active()
+
+    def _LoadQueue(self, items: List[Tuple[str, str]], autoplay: bool):
+        with self.lock:
+            self.playlist = items
+            self.playlist_loaded = min(len(items), ARGS.queue_window)
+            window = items[:self.playlist_loaded]
+        queue_items = [_QueueItem(*item) for item in window]
+        queue_items[0]["autoplay"] = autoplay
+        self.cast.media_controller.send_message(
+            {"type": "QUEUE_LOAD",
+             "items": queue_items,
+             "startIndex": 0,
+             "repeatMode": "REPEAT_OFF"},
+            inc_session_id=True)
+
+    @timed("prepare_media")
+    def PrepareMedia(self, items: List[Tuple[str, str]]):
+        """
+        Loads the items without starting playback and waits until
+        the device has buffered the first one (player state PAUSED)
+        """
+        LogHistory(self.host, "prepare_media", (items[0][0], len(items)))
+        start = time.monotonic()
+        self._LoadQueue(items, False)
+        if self.WaitForPlayerState(("PAUSED",), start, ARGS.sync_timeout) is None:
+            raise TimeoutError("media not buffered in time")
+
+    @timed("play")
+    def Play(self):
+        LogHistory(self.host, "play", "")
+        self.cast.media_controller.play()
+
+    def _RefillQueue(self, status):
+        with self.lock:
+            if not self.playlist:
+                return
+            if status.player_state == "IDLE" and status.idle_reason not in (None, "INTERRUPTED"):
+                last = self.playlist[-1][0]
+                if (status.idle_reason == "CANCELLED" or not status.content_id or
+                        (status.content_id == last and self.playlist_loaded >= len(self.playlist))):
+                    # the playlist is done so the device counts as idle
+                    # again (see ConnectionPool)
+                    self.playlist = []
+                    return
+            if not status.content_id:
+                return
+            loaded = self.playlist[:self.playlist_loaded]
+            current = next((n for n, (url, _) in enumerate(loaded)
+                            if url == status.content_id), None)
+            if current is None:
+                # somebody else took over the device
+                self.playlist = []
+                return
+            if (self.playlist_loaded - current - 1 >= ARGS.queue_refill or
+                    self.playlist_loaded >= len(self.playlist)):
+                return
+            start = self.playlist_loaded
+            self.playlist_loaded = min(len(self.playlist), start + ARGS.queue_window)
+            batch = self.playlist[start:self.playlist_loaded]
+        cast = self.cast
+        if cast is None:
+            return
+        logging.info(f"{self.host}: appending {len(batch)} items to queue at {start}")
+        cast.media_controller.send_message(
+            {"type": "QUEUE_INSERT",
+             "mediaSessionId": status.media_session_id,
+             "items": [_QueueItem(*item) for item in batch]},
+            inc_session_id=True)
+
+    @timed("play_youtube")
     def PlayYoutube(self, video_id: str):
         yt = self.cast.yt
         LogHistory(self.host, "play_video", video_id)
         yt.play_video(video_id)
 
+    @timed("load_url")
     def LoadUrl(self, url: str):
         self.cast.quit_app()
         dc = self.cast.dashcast
@@ -269,20 +1198,297 @@ class CastDeviceWrapper(pychromecast.controllers.media.MediaStatusListener,
             time.sleep(0.1)
             dc.load_url(url)
 
+    @timed("quit_app")
     def QuitApp(self):
         """This sometimes helps with stuck apps"""
         LogHistory(self.host, "quit_app", "")
         self.cast.quit_app()
 
+    @timed("queue_next")
     def QueueNext(self):
         LogHistory(self.host, "queue_next", "")
         self.cast.media_controller.queue_next()
 
+    @timed("set_volume")
     def SetVolume(self, level: float):
         LogHistory(self.host, "set_volume", str(float))
         self.cast.set_volume(level)
 
 
+############################################################
+# Subnet scanning
+# Building a full pychromecast.Chromecast is expensive, so we
+# first check which hosts accept connections on the cast port.
+############################################################
+async def _ProbeHost(host: str, port: int, timeout: float,
+                     semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+
+async def _ProbeHosts(hosts: List[str], port: int, timeout: float,
+                      concurrency: int) -> List[str]:
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(
+        *[_ProbeHost(h, port, timeout, semaphore) for h in hosts])
+    return [h for h, ok in zip(hosts, results) if ok]
+
+
+def ProbeHosts(hosts: List[str]) -> List[str]:
+    """Returns the subset of hosts which have the cast port open"""
+    return asyncio.run(_ProbeHosts(hosts, GOOGLE_CAST_PORT,
+                                   ARGS.probe_timeout, ARGS.probe_concurrency))
+
+
+############################################################
+# Device Cache
+# Remembers known devices across restarts so we can reconnect
+# to them right away instead of waiting for discovery.
+############################################################
+class DeviceCache:
+    """
+    Json file with one record (host, name, uuid, model, last_seen) per host.
+    Changes are written at most every DEVICE_CACHE_SAVE_DELAY seconds
+    (or on Flush()) so registering many devices does not rewrite the
+    file for every single one.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        # serializes writers so an older snapshot never overwrites a newer one
+        self.save_lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.dirty = False
+        self.timer: Optional[threading.Timer] = None
+        try:
+            with open(self.path) as fp:
+                self.entries = {e["host"]: e for e in json.load(fp)}
+            logging.info(f"loaded {len(self.entries)} devices from {self.path}")
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            logging.error(f"cannot read device cache {self.path}: {err}")
+
+    def Hosts(self) -> List[str]:
+        with self.lock:
+            return list(self.entries.keys())
+
+    def Update(self, cast: "CastDeviceWrapper"):
+        with self.lock:
+            self.entries[cast.host] = {"host": cast.host,
+                                       "name": cast.name,
+                                       "uuid": cast.uuid,
+                                       "model": cast.model,
+                                       "last_seen": time.time()}
+            self._MarkDirty()
+
+    def Remove(self, host: str):
+        with self.lock:
+            if self.entries.pop(host, None):
+                self._MarkDirty()
+
+    def Prune(self, live_hosts):
+        with self.lock:
+            stale = [h for h in self.entries if h not in live_hosts]
+            for host in stale:
+                logging.info(f"dropping cached device {self.entries[host]}")
+                del self.entries[host]
+            self.dirty = True
+        self.Flush()
+
+    def _MarkDirty(self):
+        """must hold self.lock"""
+        self.dirty = True
+        if self.timer is None:
+            self.timer = threading.Timer(DEVICE_CACHE_SAVE_DELAY, self.Flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def Flush(self):
+        """Writes the file now if anything changed"""
+        with self.save_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+                entries = list(self.entries.values())
+            self._Save(entries)
+
+    def _Save(self, entries: List[Dict[str, Any]]):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as fp:
+                json.dump(entries, fp, indent=1)
+            os.replace(tmp, self.path)
+        except Exception as err:
+            logging.error(f"cannot write device cache {self.path}: {err}")
+
+
+############################################################
+# Connection Pool
+# With --lazy_connections devices are only registered with
+# their metadata. Connections (a socket thread each) are opened
+# on first use and idle ones are closed again.
+############################################################
+class ConnectionPool:
+    """
+    Open connections of lazy devices in least recently used order.
+    Pinned devices stay connected and do not count against max_connections.
+    """
+
+    def __init__(self, max_connections: int, idle_timeout: float):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # host -> device, least recently used first
+        self.open: collections.OrderedDict = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.evictions = 0
+        self.connect_time = 0.0
+        if idle_timeout > 0:
+            threading.Thread(target=self._Sweep, name="pool-sweep",
+                             daemon=True).start()
+
+    def Acquire(self, device: CastDeviceWrapper):
+        with self.lock:
+            device.busy += 1
+        try:
+            with device.connect_lock:
+                with self.lock:
+                    connected = device.cast is not None
+                    if connected:
+                        self.hits += 1
+                        if device.host in self.open:
+                            self.open.move_to_end(device.host)
+                    else:
+                        self.misses += 1
+                if connected:
+                    return
+                start = time.monotonic()
+                with TimingPhase("connect"):
+                    device.Connect()
+                elapsed = time.monotonic() - start
+        except Exception:
+            with self.lock:
+                device.busy -= 1
+                self.failures += 1
+            raise
+        METRICS.Observe("mqtt2cast_connect_duration_seconds",
+                        (("device", device.name),), elapsed)
+        with self.lock:
+            self.connect_time += elapsed
+            self.open[device.host] = device
+            victims = self._Victims(time.monotonic())
+        self._Close(victims)
+
+    def Release(self, device: CastDeviceWrapper):
+        with self.lock:
+            device.busy -= 1
+            device.last_used = time.monotonic()
+            if device.busy or not device.drop_pending:
+                return
+            victims = [self._Detach(device)]
+        self._Close(victims)
+
+    def Pin(self, device: CastDeviceWrapper):
+        device.pinned = True
+        self.Acquire(device)
+        self.Release(device)
+
+    def Drop(self, device: CastDeviceWrapper):
+        with self.lock:
+            if device.busy:
+                # a running command still uses the connection, see Release
+                device.drop_pending = True
+                return
+            victims = [self._Detach(device)]
+        self._Close(victims)
+
+    def _Detach(self, device: CastDeviceWrapper):
+        """must hold self.lock"""
+        self.open.pop(device.host, None)
+        device.drop_pending = False
+        return device, device.Detach()
+
+    def _Victims(self, now: float):
+        """
+        Detaches the connections that should be closed - must hold self.lock
+        """
+        unpinned = [d for d in self.open.values() if not d.pinned]
+        excess = len(unpinned) - self.max_connections
+        out = []
+        for device in unpinned:
+            # busy devices and devices we feed a playlist to are not idle
+            if device.busy or device.playlist:
+                continue
+            expired = (self.idle_timeout > 0 and
+                       now - device.last_used > self.idle_timeout)
+            if excess <= 0 and not expired:
+                continue
+            excess -= 1
+            out.append(self._Detach(device))
+        self.evictions += len(out)
+        return out
+
+    def _Close(self, victims):
+        for device, cast in victims:
+            if cast is None:
+                continue
+            logging.info(f"closing connection to {device.name} at {device.host}")
+            try:
+                cast.disconnect(blocking=False)
+            except Exception as err:
+                logging.warning(f"disconnect failed for {device.host}: {err}")
+
+    @exception
+    def _Sweep(self):
+        while True:
+            time.sleep(max(1.0, self.idle_timeout / 2))
+            with self.lock:
+                victims = self._Victims(time.monotonic())
+            self._Close(victims)
+
+    def Stats(self) -> Dict[str, Any]:
+        with self.lock:
+            pinned = sum(1 for d in self.open.values() if d.pinned)
+            connects = self.misses - self.failures
+            lookups = self.hits + self.misses
+            return {"open": len(self.open) - pinned,
+                    "pinned": pinned,
+                    "max_connections": self.max_connections,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                    "failures": self.failures,
+                    "evictions": self.evictions,
+                    "avg_connect_seconds":
+                        round(self.connect_time / connects, 3) if connects else None}
+
+
+def ParseGroups(specs: List[str]) -> Dict[str, List[str]]:
+    groups = {}
+    for spec in specs:
+        name, _, members = spec.partition("=")
+        groups[name.strip()] = [m.strip() for m in members.split(",") if m.strip()]
+    return groups
+
+
 class CastDeviceManager:
     """
     Manages all the cast devices in the network
@@ -291,63 +1497,363 @@ class CastDeviceManager:
     def __init__(self):
         self.host_map: Dict[str, CastDeviceWrapper] = {}
         self.name_map: Dict[str, CastDeviceWrapper] = {}
-        self.UpdateCastDevices()
+        self.last_scan: Dict[str, Any] = {}
+        # group name -> members (friendly names, ips or patterns)
+        self.groups: Dict[str, List[str]] = ParseGroups(ARGS.group or [])
+        self.lock = threading.Lock()
+        # hosts with a registration in progress
+        self.registering = set()
+        self.zconf: Optional[zeroconf.Zeroconf] = None
+        self.browser: Optional[zeroconf.ServiceBrowser] = None
+        # zeroconf service name -> hosts
+        self.service_map: Dict[str, List[str]] = {}
+        self.registration_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix="register")
+        self.reconnect_attempts: Dict[str, int] = {}
+        self.reconnect_timers: Dict[str, threading.Timer] = {}
+        self.device_cache: Optional[DeviceCache] = None
+        if ARGS.device_cache:
+            self.device_cache = DeviceCache(ARGS.device_cache)
+        # cluster mode: discovered hosts owned by other nodes
+        self.foreign = set()
+        self.pool: Optional[ConnectionPool] = None
+        if ARGS.lazy_connections:
+            self.pool = ConnectionPool(ARGS.max_connections,
+                                       ARGS.connection_idle_timeout)
+        self.discovery_done = threading.Event()
+
+    def StartDiscovery(self):
+        """Runs the initial discovery in the background"""
+        threading.Thread(target=self._InitialDiscovery,
+                         name="discovery", daemon=True).start()
 
-    def _RegisterCastDevice(self, host):
+    @exception
+    def _InitialDiscovery(self):
+        global STARTUP, CLUSTER, COMMAND_DISPATCHER
+        try:
+            if CLUSTER:
+                # do not claim devices before we know the other nodes
+                CLUSTER.WaitForMembers()
+                STARTUP.Mark("cluster")
+            cached_hosts = self.device_cache.Hosts() if self.device_cache else []
+            if cached_hosts:
+                # warm start: reconnect to known devices right away and
+                # confirm/drop the cache entries with the discovery below
+                with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
+                    executor.map(self._RegisterCastDevice, cached_hosts)
+                self.device_cache.Flush()
+                STARTUP.Mark("cached_devices")
+            self.UpdateCastDevices()
+            if ARGS.use_zeroconf:
+                time.sleep(ZEROCONF_SETTLE_TIME)
+            if self.device_cache:
+                self.device_cache.Prune(self.host_map)
+        finally:
+            self.discovery_done.set()
+            # commands held for devices which did not show up fail now
+            COMMAND_DISPATCHER.Unpark()
+            STARTUP.Mark("discovery", ready=True)
 
+    def _RegisterCastDevice(self, host):
+        global CLUSTER, COMMAND_DISPATCHER
+        with self.lock:
+            if CLUSTER and not CLUSTER.Owns(host):
+                self.foreign.add(host)
+                return
+            self.foreign.discard(host)
+            if host in self.host_map or host in self.registering:
+                return
+            self.registering.add(host)
         try:
-            cast = CastDeviceWrapper(host)
-            logging.info(f"adding host: [{cast.host}]")
-            self.host_map[cast.host] = cast
-            logging.info(f"adding name: [{cast.name}]")
-            self.name_map[cast.name] = cast
-            MQTT_CLIENT.EmitMessage(
-                f"{MESSAGE_PREFIX}devices",
-                json.dumps(list(self.name_map.keys())))
+            cast = CastDeviceWrapper(host, self.pool is not None)
+            if self.pool and self._IsPinned(cast):
+                self.pool.Pin(cast)
+            with self.lock:
+                logging.info(f"adding host: [{cast.host}]")
+                self.host_map[cast.host] = cast
+                logging.info(f"adding name: [{cast.name}]")
+                self.name_map[cast.name] = cast
+            # run the commands which were waiting for this device
+            COMMAND_DISPATCHER.Unpark()
+            if self.device_cache:
+                self.device_cache.Update(cast)
+            METRICS.Inc("mqtt2cast_registrations_total", (("result", "ok"),))
+            self._PublishDevices(added=[cast.name])
         except Exception as err:
+            METRICS.Inc("mqtt2cast_registrations_total", (("result", "failed"),))
             if not isinstance(err, pychromecast.error.ChromecastConnectionError):
                 logging.error(
                     f"registration failed for {host}: {type(err)} {err}")
             # self.history.log(host, "registration_error", str(err))
+        finally:
+            with self.lock:
+                self.registering.discard(host)
+
+    def _IsPinned(self, cast: CastDeviceWrapper) -> bool:
+        return any(p in (cast.host, cast.name) or fnmatch.fnmatchcase(cast.name, p)
+                   for p in ARGS.pin or [])
+
+    def _UnregisterCastDevice(self, host):
+        with self.lock:
+            cast = self.host_map.pop(host, None)
+            if cast is None:
+                return
+            if self.name_map.get(cast.name) is cast:
+                del self.name_map[cast.name]
+        logging.info(f"removing device: [{cast.name}] at {host}")
+        if self.device_cache:
+            self.device_cache.Remove(host)
+        if self.pool:
+            self.pool.Drop(cast)
+        else:
+            cast.Disconnect()
+
+    def _Snapshot(self) -> Dict[str, str]:
+        with self.lock:
+            return {host: cast.name for host, cast in self.host_map.items()}
+
+    def _PublishDevices(self, added=[], removed=[], changed=[]):
+        global CLUSTER
+        if CLUSTER:
+            # let the other nodes know right away (see Cluster.Handles)
+            CLUSTER.Announce()
+        MQTT_CLIENT.EmitMessage(
+            NodeTopic(f"{MESSAGE_PREFIX}devices"),
+            json.dumps({"devices": sorted(self.name_map.keys()),
+                        "added": added,
+                        "removed": removed,
+                        "changed": changed}))
+
+    def ScheduleReconnect(self, host: str):
+        """
+        Reconnects a device which lost its connection using exponential backoff.
+        Gives up after RECONNECT_MAX_ATTEMPTS and drops the device.
+        """
+        with self.lock:
+            if host in self.reconnect_timers:
+                return
+            attempt = self.reconnect_attempts.get(host, 0)
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)
+            timer = threading.Timer(delay, self._Reconnect, (host,))
+            timer.daemon = True
+            self.reconnect_timers[host] = timer
+        logging.info(f"reconnect attempt {attempt} for {host} in {delay}s")
+        timer.start()
+
+    def _CancelReconnect(self, host: str):
+        with self.lock:
+            timer = self.reconnect_timers.pop(host, None)
+            self.reconnect_attempts.pop(host, None)
+        if timer:
+            timer.cancel()
+
+    @exception
+    def _Reconnect(self, host: str):
+        with self.lock:
+            self.reconnect_timers.pop(host, None)
+            attempt = self.reconnect_attempts.get(host, 0) + 1
+            self.reconnect_attempts[host] = attempt
+        cast = self.host_map.get(host)
+        if cast and cast.IsHealthy():
+            # pychromecast managed to reconnect on its own
+            self._CancelReconnect(host)
+            return
+        name = cast.name if cast else host
+        self._UnregisterCastDevice(host)
+        self._RegisterCastDevice(host)
+        if host in self.host_map:
+            self._CancelReconnect(host)
+        elif attempt < RECONNECT_MAX_ATTEMPTS:
+            self.ScheduleReconnect(host)
+        else:
+            logging.warning(f"giving up on {host} after {attempt} attempts")
+            self._CancelReconnect(host)
+            self._PublishDevices(removed=[name])
+
+    def _ServiceHosts(self, zc, type, name) -> List[str]:
+        info = zc.get_service_info(type, name)
+        if info is None:
+            return []
+        ips = zc.cache.entries_with_name(info.server.lower())
+        return [repr(dnsaddress) for dnsaddress in ips]
+
+    @exception
+    def _AddService(self, zc, type, name):
+        hosts = self._ServiceHosts(zc, type, name)
+        with self.lock:
+            self.service_map[name] = hosts
+        for host in hosts:
+            self._RegisterCastDevice(host)
+
+    @exception
+    def _UpdateService(self, zc, type, name):
+        hosts = self._ServiceHosts(zc, type, name)
+        with self.lock:
+            old_hosts = self.service_map.get(name, [])
+            self.service_map[name] = hosts
+        removed = []
+        for host in old_hosts:
+            if host not in hosts:
+                if host in self.host_map:
+                    removed.append(self.host_map[host].name)
+                self._CancelReconnect(host)
+                self._UnregisterCastDevice(host)
+        if removed:
+            self._PublishDevices(removed=removed)
+        for host in hosts:
+            cast = self.host_map.get(host)
+            if cast and not cast.IsHealthy():
+                self._UnregisterCastDevice(host)
+            self._RegisterCastDevice(host)
+
+    @exception
+    def _RemoveService(self, name):
+        with self.lock:
+            hosts = self.service_map.pop(name, [])
+            self.foreign.difference_update(hosts)
+        removed = [self.host_map[h].name for h in hosts if h in self.host_map]
+        for host in hosts:
+            self._CancelReconnect(host)
+            self._UnregisterCastDevice(host)
+        if removed:
+            self._PublishDevices(removed=removed)
+
+    # The zeroconf listener api: these run on zeroconf's thread and
+    # must not block, so all the work is done by the registration pool.
 
     # part of the zeroconf listener api
     @exception
     def remove_service(self, zc, type, name):
-        pass
+        self.registration_pool.submit(self._RemoveService, name)
 
     # part of the zeroconf listener api
     @exception
     def add_service(self, zc, type, name):
-        info = zc.get_service_info(type, name)
-        ips = zc.cache.entries_with_name(info.server.lower())
-        assert ips
-        for dnsaddress in ips:
-            host = repr(dnsaddress)
-            self._RegisterCastDevice(host)
+        self.registration_pool.submit(self._AddService, zc, type, name)
+
+    # part of the zeroconf listener api
+    @exception
+    def update_service(self, zc, type, name):
+        self.registration_pool.submit(self._UpdateService, zc, type, name)
 
     def UpdateCastDevices(self):
-        if ARGS.use_zeroconf:
+        if ARGS.use_zeroconf and self.zconf is None:
             # note there is also pychromecast.get_chromecasts()
-            zc = zeroconf.Zeroconf()
-            browser = zeroconf.ServiceBrowser(
-                zc, GOOGLE_CAST_IDENTIFIER, self)
+            # the browser keeps running and reports devices as they appear
+            self.zconf = zeroconf.Zeroconf()
+            self.browser = zeroconf.ServiceBrowser(
+                self.zconf, GOOGLE_CAST_IDENTIFIER, self)
+        if ARGS.scan_subnets:
+            self.ScanSubnets(ARGS.scan_subnets)
+
+    def Rescan(self):
+        """
+        Incremental rescan: healthy known devices are left alone,
+        stale devices are reconnected (or dropped) and only unknown
+        addresses are probed. Publishes the resulting diff.
+        """
+        before = self._Snapshot()
+        stale = [host for host, cast in list(self.host_map.items())
+                 if not cast.IsHealthy()]
+        for host in stale:
+            self._UnregisterCastDevice(host)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
+            executor.map(self._RegisterCastDevice, stale)
         if ARGS.scan_subnets:
-            hosts = []
-            for sn in ARGS.scan_subnets:
-                hosts += [h.compressed for h in ipaddress.ip_network(sn)]
-            with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
-                executor.map(self._RegisterCastDevice, hosts)
+            self.ScanSubnets(ARGS.scan_subnets)
+        after = self._Snapshot()
+        added = [after[h] for h in after if h not in before]
+        removed = [before[h] for h in before if h not in after]
+        changed = [{"host": h, "old": before[h], "new": after[h]}
+                   for h in after if h in before and before[h] != after[h]]
+        logging.info(f"rescan: added {added} removed {removed} changed {changed}")
+        self._PublishDevices(added=added, removed=removed, changed=changed)
+
+    def ScanSubnets(self, subnets: List[str]):
+        start = time.monotonic()
+        hosts = []
+        for sn in subnets:
+            hosts += [h.compressed for h in ipaddress.ip_network(sn)
+                      if h.compressed not in self.host_map]
+        responsive = ProbeHosts(hosts)
+        probe_done = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
+            executor.map(self._RegisterCastDevice, responsive)
+        done = time.monotonic()
+        METRICS.Observe("mqtt2cast_discovery_duration_seconds", (), done - start)
+        self.last_scan = {"subnets": subnets,
+                          "hosts": len(hosts),
+                          "responsive": len(responsive),
+                          "probe_duration": round(probe_done - start, 3),
+                          "register_duration": round(done - probe_done, 3),
+                          "duration": round(done - start, 3),
+                          "time": time.strftime("%y/%m/%d %H:%M:%S")}
+        logging.info(f"subnet scan: {self.last_scan}")
+        MQTT_CLIENT.EmitMessage(
+            NodeTopic(f"{MESSAGE_PREFIX}sys/scan"), json.dumps(self.last_scan))
 
-    def GetCasts(self, host: str):
-        if not host:
-            return list(self.host_map.values())
+    def SetGroup(self, name: str, members: List[str]):
+        with self.lock:
+            if members:
+                self.groups[name] = members
+            else:
+                self.groups.pop(name, None)
+        logging.info(f"group [{name}]: {members}")
+
+    def _LookupCasts(self, host: str):
         if host in self.host_map:
             return [self.host_map[host]]
         if host in self.name_map:
             return [self.name_map[host]]
-        logging.warning(f"host not found: [{host}] {self.name_map.keys()}")
+        if any(c in host for c in "*?["):
+            return [cast for name, cast in sorted(self.name_map.items())
+                    if fnmatch.fnmatchcase(name, host)]
         return []
 
+    def _ResolveCasts(self, host: str):
+        if not host:
+            return list(self.host_map.values())
+        if host in self.groups:
+            out = []
+            for member in self.groups[host]:
+                out += [c for c in self._LookupCasts(member) if c not in out]
+            return out
+        return self._LookupCasts(host)
+
+    def GetCasts(self, host: str):
+        """
+        host can be an ip, a friendly name, a group (see --group),
+        a wildcard pattern for friendly names or empty for all devices
+        """
+        out = self._ResolveCasts(host)
+        if not out:
+            logging.warning(f"host not found: [{host}] {self.name_map.keys()}")
+        return out
+
+    @exception
+    def Rebalance(self):
+        """
+        Cluster membership changed: hands over the devices now owned by
+        another node and takes over the ones we own now
+        """
+        global CLUSTER
+        with self.lock:
+            give = [h for h in self.host_map if not CLUSTER.Owns(h)]
+            take = [h for h in self.foreign if CLUSTER.Owns(h)]
+        if not give and not take:
+            return
+        logging.info(f"rebalance: giving up {give} taking over {take}")
+        removed = [self.host_map[h].name for h in give if h in self.host_map]
+        for host in give:
+            self._CancelReconnect(host)
+            self._UnregisterCastDevice(host)
+            with self.lock:
+                self.foreign.add(host)
+        if removed:
+            self._PublishDevices(removed=removed)
+        for host in take:
+            self.registration_pool.submit(self._RegisterCastDevice, host)
+
     def __str__(self):
         out = []
         for dev, cast in self.device_map.items():
@@ -355,15 +1861,757 @@ class CastDeviceManager:
         return "\n".join(out)
 
 
+############################################################
+# Cluster
+# Several instances can share a broker (--cluster_node). Every
+# device is owned by exactly one of them, chosen by rendezvous
+# hashing over the live nodes, so a node joining or leaving only
+# moves the devices it gains or loses.
+############################################################
+def NodeTopic(topic: str) -> str:
+    """
+    In cluster mode every node publishes topics like sys/ready for
+    itself, they get the node as last segment
+    """
+    return f"{topic}/{ARGS.cluster_node}" if ARGS.cluster_node else topic
+
+
+def _RendezvousScore(node: str, key: str) -> bytes:
+    return hashlib.sha1(bytes(f"{node}|{key}", "utf-8")).digest()
+
+
+class Cluster:
+    """
+    Tracks the live nodes via their retained heartbeats on
+    mqtt2cast/cluster/<node> and their will messages on
+    mqtt2cast/sys/status/<node>.
+    Devices are keyed by host since that is known before connecting.
+    The heartbeats also carry the devices of a node so every node can
+    tell whether a target belongs to another node.
+    """
+
+    def __init__(self, node: str, heartbeat: float):
+        self.node = node
+        self.heartbeat = heartbeat
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        # node -> time.monotonic() of its last heartbeat
+        self.members: Dict[str, float] = {node: self.started}
+        # node -> {host: friendly name} of the devices it owns
+        self.devices: Dict[str, Dict[str, str]] = {}
+        self.wakeup = threading.Event()
+        self.changes = 0
+
+    def Start(self):
+        threading.Thread(target=self._Run, name="cluster", daemon=True).start()
+
+    def Owner(self, key: str) -> str:
+        with self.lock:
+            nodes = list(self.members)
+        return max(nodes, key=lambda n: _RendezvousScore(n, key))
+
+    def Owns(self, key: str) -> bool:
+        return self.Owner(key) == self.node
+
+    def WaitForMembers(self):
+        """Gives the (retained) heartbeats of the other nodes one period to arrive"""
+        time.sleep(max(0.0, self.started + self.heartbeat - time.monotonic()))
+
+    def _Changed(self):
+        global CAST_DEVICES
+        self.changes += 1
+        logging.info(f"cluster members: {sorted(self.members)}")
+        if CAST_DEVICES:
+            # not on paho's thread
+            CAST_DEVICES.registration_pool.submit(CAST_DEVICES.Rebalance)
+
+    def Join(self, node: str, payload: str):
+        """A (retained) heartbeat from another node"""
+        if node == self.node:
+            return
+        try:
+            data = json.loads(payload) if payload else {}
+            sent = data.get("time", 0.0)
+            devices = data.get("names", {})
+        except (ValueError, AttributeError):
+            logging.warning(f"bad cluster heartbeat from {node}: {payload}")
+            return
+        if time.time() - sent > 3 * self.heartbeat:
+            # a stale retained heartbeat of a node which is gone
+            self.Leave(node)
+            return
+        with self.lock:
+            new = node not in self.members
+            self.members[node] = time.monotonic()
+            self.devices[node] = devices
+            if new:
+                self._Changed()
+
+    def Leave(self, node: str):
+        if node == self.node:
+            return
+        with self.lock:
+            self.devices.pop(node, None)
+            if self.members.pop(node, None) is not None:
+                logging.warning(f"cluster node {node} is gone")
+                self._Changed()
+
+    def Announce(self):
+        """Sends the next heartbeat early because our devices changed"""
+        self.wakeup.set()
+
+    def _Heartbeat(self):
+        global MQTT_CLIENT, CAST_DEVICES
+        names = CAST_DEVICES._Snapshot() if CAST_DEVICES else {}
+        MQTT_CLIENT.EmitMessage(
+            f"{MESSAGE_PREFIX}cluster/{self.node}",
+            json.dumps({"node": self.node,
+                        "time": time.time(),
+                        "devices": len(names),
+                        "names": names}))
+
+    def _Run(self):
+        while True:
+            self._Heartbeat()
+            now = time.monotonic()
+            with self.lock:
+                self.members[self.node] = now
+                gone = [n for n, last in self.members.items()
+                        if now - last > 3 * self.heartbeat]
+            for node in gone:
+                self.Leave(node)
+            if self.wakeup.wait(self.heartbeat):
+                # batch the changes of a discovery into one heartbeat
+                time.sleep(CLUSTER_ANNOUNCE_DELAY)
+                self.wakeup.clear()
+
+    def _RemoteDevice(self, target: str) -> bool:
+        """Whether target is a single device announced by another node"""
+        with self.lock:
+            return any(target in names or target in names.values()
+                       for node, names in self.devices.items() if node in self.members)
+
+    def RemoteMatches(self, target: str) -> bool:
+        """Whether another node announced a device matching target"""
+        global CAST_DEVICES
+        patterns = CAST_DEVICES.groups.get(target, [target]) if target else ["*"]
+        with self.lock:
+            remote = [item for node, names in self.devices.items() if node in self.members
+                      for item in names.items()]
+        return any(p in (host, name) or fnmatch.fnmatchcase(name, p)
+                   for host, name in remote for p in patterns)
+
+    def Handles(self, cmd: "Command") -> bool:
+        """
+        Whether this node executes the command: nodes owning a matching
+        device do (all of them for rescans), each publishes the result of
+        its part. While our own discovery is running we also take commands
+        for devices nobody announced yet, they may turn out to be ours.
+        If no node has a matching device the owner of the target string
+        reports the failure.
+        """
+        global CAST_DEVICES
+        if cmd.action == "rescan":
+            return True
+        if CAST_DEVICES._ResolveCasts(cmd.target):
+            return True
+        if self._RemoteDevice(cmd.target):
+            return False
+        try:
+            ipaddress.ip_address(cmd.target)
+            return self.Owns(cmd.target)
+        except ValueError:
+            pass
+        if not CAST_DEVICES.discovery_done.is_set():
+            # the device may still show up (see CommandDispatcher.Unpark)
+            return True
+        if self.RemoteMatches(cmd.target):
+            return False
+        return self.Owns(cmd.target)
+
+    def CheckRemote(self, target: str):
+        """
+        Called when none of our devices matches target: raises
+        RemoteCommand if the command is left to the other nodes
+        """
+        if self.RemoteMatches(target) or not self.Owns(target):
+            raise RemoteCommand(target)
+
+    def Stats(self) -> Dict[str, Any]:
+        global CAST_DEVICES
+        with self.lock:
+            members = sorted(self.members)
+        return {"node": self.node,
+                "members": members,
+                "changes": self.changes,
+                "owned": len(CAST_DEVICES.host_map),
+                "foreign": len(CAST_DEVICES.foreign)}
+
+
+def HandleClusterTopic(segments: List[str], payload: str):
+    global CLUSTER
+    node, = segments
+    CLUSTER.Join(node, payload)
+
+
+def HandleSysTopic(segments: List[str], payload: str):
+    """mqtt2cast/sys/status/<node>, "0" is the will message of a node"""
+    global CLUSTER
+    kind, node = segments
+    if kind == "status" and payload == "0":
+        CLUSTER.Leave(node)
+
+
+############################################################
+# Command Dispatch
+# Commands are not executed on paho's network thread but handed
+# to a worker per device. This way a slow or unresponsive device
+# only delays its own commands (and never the mqtt keepalives).
+############################################################
+class RemoteCommand(Exception):
+    """
+    Cluster mode: the devices of the command are owned by other nodes
+    which publish the result, this node stays silent
+    """
+
+
+class Command(NamedTuple):
+    """
+    A parsed request like mqtt2cast/action/<target>/<action> <payload>.
+    target is a device (friendly name or ip), a group, a wildcard
+    pattern or the empty string for all devices.
+    """
+    target: str
+    action: str
+    payload: str
+    # correlation id - if set the outcome is published on mqtt2cast/result/<id>
+    id: str = ""
+
+
+def ParseCommand(target: str, action: str, payload: str) -> Command:
+    """
+    The payload is either the plain argument or json like
+    {"id": "<correlation id>", "arg": "<argument>"}
+    """
+    if payload.startswith("{"):
+        try:
+            data = json.loads(payload)
+            return Command(target, action, str(data.get("arg", "")), str(data.get("id", "")))
+        except ValueError:
+            pass
+    return Command(target, action, payload)
+
+
+def PublishResult(cmd: Command, status: str, error: str = "",
+                  timing: Optional[Dict[str, float]] = None):
+    global MQTT_CLIENT, CLUSTER
+    if not cmd.id:
+        return
+    result = {"id": cmd.id,
+              "action": cmd.action,
+              "target": cmd.target,
+              "status": status,
+              "error": error,
+              "timing": timing or {}}
+    if CLUSTER:
+        result["node"] = CLUSTER.node
+    MQTT_CLIENT.EmitMessage(
+        NodeTopic(f"{MESSAGE_PREFIX}result/{cmd.id}"), json.dumps(result),
+        retain=False)
+
+
+class QueuedCommand:
+    __slots__ = ["submitted", "wrapper", "cmd"]
+
+    def __init__(self, wrapper, cmd: Command):
+        self.submitted = time.monotonic()
+        self.wrapper = wrapper
+        self.cmd = cmd
+
+    def Name(self) -> str:
+        return self.cmd.action
+
+
+class QueuedCall:
+    """
+    A call on behalf of a command from another worker, e.g. one device
+    of a broadcast (see CommandDispatcher.Call)
+    """
+    __slots__ = ["submitted", "function", "future"]
+
+    def __init__(self, function):
+        self.submitted = time.monotonic()
+        self.function = function
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+    def Name(self) -> str:
+        return ""
+
+    def Run(self):
+        if not self.future.set_running_or_notify_cancel():
+            # the caller gave up on it before it started
+            return
+        try:
+            self.future.set_result(self.function())
+        except Exception as err:
+            self.future.set_exception(err)
+
+
+class DeviceWorker:
+    """
+    Executes the commands for a single target device in order, including
+    the calls other workers make on the device (broadcasts, groups, ...).
+    The SHARED_QUEUE key is used for all other commands.
+
+    Commands listed in COALESCED_ACTIONS are latest-wins: a newer command
+    replaces the last pending command if it is of the same kind.
+    """
+
+    def __init__(self, key: str, max_queue: int, on_idle):
+        self.key = key
+        self.max_queue = max_queue
+        # called when there was nothing to do for WORKER_IDLE_TIMEOUT,
+        # the worker stops if it returns True
+        self.on_idle = on_idle
+        self.cond = threading.Condition()
+        self.pending: collections.deque = collections.deque()
+        # targets of the pending and the running command
+        self.targets: collections.Counter = collections.Counter()
+        self.running = False
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.thread = threading.Thread(
+            target=self._Run, name=f"worker-{key}", daemon=True)
+        self.thread.start()
+
+    def Submit(self, wrapper, cmd: Command) -> bool:
+        queued = QueuedCommand(wrapper, cmd)
+        with self.cond:
+            last = self.pending[-1] if self.pending else None
+            if (cmd.action in COALESCED_ACTIONS and last and
+                    last.Name() == cmd.action and last.cmd.target == cmd.target):
+                # only the last pending command is replaced so the order of
+                # commands is preserved, the submit time of the old one is kept
+                PublishResult(last.cmd, "coalesced")
+                last.wrapper, last.cmd = wrapper, cmd
+                self.coalesced += 1
+                return True
+            if len(self.pending) >= self.max_queue:
+                self.dropped += 1
+                logging.warning(f"queue for [{self.key}] is full - dropping command {cmd}")
+                PublishResult(cmd, "dropped", "queue full")
+                return False
+            self.pending.append(queued)
+            self.targets[cmd.target] += 1
+            self.cond.notify()
+        return True
+
+    def Call(self, function) -> concurrent.futures.Future:
+        queued = QueuedCall(function)
+        with self.cond:
+            if len(self.pending) >= self.max_queue:
+                self.dropped += 1
+                queued.future.set_exception(RuntimeError(f"queue for [{self.key}] is full"))
+                return queued.future
+            self.pending.append(queued)
+            self.cond.notify()
+        return queued.future
+
+    def Targets(self) -> List[str]:
+        with self.cond:
+            return list(self.targets)
+
+    def _Next(self):
+        window = ARGS.coalesce_window_ms / 1000.0
+        with self.cond:
+            while True:
+                if not self.pending:
+                    if not self.cond.wait(WORKER_IDLE_TIMEOUT):
+                        return None
+                    continue
+                cmd = self.pending[0]
+                if cmd.Name() in COALESCED_ACTIONS:
+                    # give newer commands of the same kind a chance to replace this one
+                    remaining = cmd.submitted + window - time.monotonic()
+                    if remaining > 0:
+                        self.cond.wait(remaining)
+                        continue
+                self.running = True
+                return self.pending.popleft()
+
+    def _Run(self):
+        while True:
+            queued = self._Next()
+            if queued is None:
+                if self.on_idle(self):
+                    return
+                continue
+            if isinstance(queued, QueuedCall):
+                queued.Run()
+                with self.cond:
+                    self.running = False
+                continue
+            wait = time.monotonic() - queued.submitted
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait > ARGS.queue_wait_warning:
+                logging.warning(
+                    f"command {queued.cmd} waited {wait:.2f}s in queue for [{self.key}] (depth {len(self.pending)})")
+            # the raw target would create a series per typo or pattern
+            labels = (("action", queued.cmd.action), ("queue", self.key))
+            METRICS.Observe("mqtt2cast_command_queue_seconds", labels, wait)
+            start = time.monotonic()
+            result = "ok"
+            error = ""
+            timing = CommandTiming()
+            timing.Add("queue", wait)
+            COMMAND_CONTEXT.timing = timing
+            try:
+                queued.wrapper(queued.cmd)
+            except RemoteCommand:
+                result = "remote"
+            except Exception as err:
+                result = "failed"
+                error = f"{type(err).__name__}: {err}"
+                logging.error(f"command {queued.cmd} failed: {type(err)} {err}")
+            finally:
+                COMMAND_CONTEXT.timing = None
+            duration = time.monotonic() - start
+            if timing.errors and result == "ok":
+                result = "failed"
+                error = "; ".join(timing.errors)
+            METRICS.Observe("mqtt2cast_command_duration_seconds", labels, duration)
+            if ARGS.slow_command_ms and duration * 1000 > ARGS.slow_command_ms:
+                LogSlowCommand(queued.cmd, result, wait, duration, timing)
+            if queued.cmd.id and result != "remote":
+                report = timing.Report()
+                report["total"] = round(wait + duration, 4)
+                PublishResult(queued.cmd, result, error, report)
+            METRICS.Inc("mqtt2cast_commands_total", labels + (("result", result),))
+            with self.cond:
+                self.targets[queued.cmd.target] -= 1
+                if self.targets[queued.cmd.target] <= 0:
+                    del self.targets[queued.cmd.target]
+                self.processed += 1
+                self.running = False
+
+    def Stats(self) -> Dict[str, Any]:
+        return {"depth": len(self.pending),
+                "running": int(self.running),
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "last_wait": round(self.last_wait, 3),
+                "max_wait": round(self.max_wait, 3)}
+
+
+class CommandDispatcher:
+    """
+    Routes commands to the DeviceWorker of their target device,
+    creating workers on demand and stopping them when they are idle.
+    Commands for anything but a single known device (all devices, groups,
+    patterns and devices not discovered yet) go to the SHARED_QUEUE worker,
+    so the number of workers is bounded by the number of devices.
+    The shared worker runs the per device part of its commands on the
+    device workers (see Call and RunOnCasts), so all calls for a device
+    happen in the order the commands arrived.
+    While the initial discovery is running commands for unknown devices
+    are parked (not queued) for up to --hold_unknown seconds and routed
+    once their device shows up (see Unpark).
+    """
+
+    def __init__(self, max_queue: int):
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.workers: Dict[str, DeviceWorker] = {}
+        # (deadline, wrapper, cmd) in arrival order
+        self.parked: List[Tuple[float, Any, Command]] = []
+
+    def _WorkerKey(self, target: str) -> str:
+        # make sure name and ip of the same device share one queue
+        global CAST_DEVICES
+        if CAST_DEVICES:
+            if target in CAST_DEVICES.host_map:
+                return target
+            if target in CAST_DEVICES.name_map:
+                return CAST_DEVICES.name_map[target].host
+        return SHARED_QUEUE
+
+    def _SharedQueueHolds(self, host: str) -> bool:
+        """
+        True if a command in the shared queue involves the device, later
+        commands for it must then wait behind it in the shared queue
+        """
+        global CAST_DEVICES
+        shared = self.workers.get(SHARED_QUEUE)
+        if shared is None or CAST_DEVICES is None:
+            return False
+        for target in shared.Targets():
+            if any(cast.host == host for cast in CAST_DEVICES._ResolveCasts(target)):
+                return True
+        return False
+
+    def _Worker(self, key: str) -> DeviceWorker:
+        """must hold self.lock"""
+        worker = self.workers.get(key)
+        if worker is None:
+            worker = DeviceWorker(key, self.max_queue, self._Retire)
+            self.workers[key] = worker
+        return worker
+
+    def Call(self, host: str, function) -> concurrent.futures.Future:
+        """
+        Runs function() on the worker of the device so it is ordered with
+        the other commands for it. Runs it right away if we are on that
+        worker already.
+        """
+        with self.lock:
+            worker = self._Worker(host)
+            if threading.current_thread() is not worker.thread:
+                # submit while holding the lock so the worker cannot retire meanwhile
+                return worker.Call(function)
+        queued = QueuedCall(function)
+        queued.Run()
+        return queued.future
+
+    def _Retire(self, worker: DeviceWorker) -> bool:
+        with self.lock:
+            with worker.cond:
+                if worker.pending:
+                    return False
+                if self.workers.get(worker.key) is worker:
+                    del self.workers[worker.key]
+        logging.info(f"stopped idle worker for [{worker.key}]")
+        return True
+
+    def _Route(self, wrapper, cmd: Command) -> bool:
+        """must hold self.lock"""
+        key = self._WorkerKey(cmd.target)
+        if key != SHARED_QUEUE and self._SharedQueueHolds(key):
+            key = SHARED_QUEUE
+        # submit while holding the lock so the worker cannot retire meanwhile
+        return self._Worker(key).Submit(wrapper, cmd)
+
+    def _MustPark(self, cmd: Command) -> bool:
+        global CAST_DEVICES
+        if CAST_DEVICES is None or cmd.action == "rescan":
+            return False
+        if CAST_DEVICES.discovery_done.is_set():
+            return False
+        return not CAST_DEVICES._ResolveCasts(cmd.target)
+
+    def _Unpark(self):
+        """must hold self.lock"""
+        if not self.parked:
+            return
+        now = time.monotonic()
+        parked = self.parked
+        self.parked = []
+        for deadline, wrapper, cmd in parked:
+            if deadline > now and self._MustPark(cmd):
+                self.parked.append((deadline, wrapper, cmd))
+            else:
+                self._Route(wrapper, cmd)
+
+    def Unpark(self):
+        """
+        Routes the parked commands whose device showed up, which waited
+        long enough or all of them once the discovery is done
+        """
+        with self.lock:
+            self._Unpark()
+
+    def Submit(self, cmd: Command) -> bool:
+        wrapper = ACTION_MAP.get(cmd.action)
+        if wrapper is None:
+            logging.warning(f"unknown action: {cmd}")
+            PublishResult(cmd, "failed", "unknown action")
+            return False
+        with self.lock:
+            # parked commands which can run now go first
+            self._Unpark()
+            if self._MustPark(cmd):
+                logging.info(f"parking command for unknown device: {cmd}")
+                self.parked.append(
+                    (time.monotonic() + ARGS.hold_unknown, wrapper, cmd))
+                timer = threading.Timer(ARGS.hold_unknown, self.Unpark)
+                timer.daemon = True
+                timer.start()
+                return True
+            return self._Route(wrapper, cmd)
+
+    def Stats(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            workers = list(self.workers.values())
+        return {w.key: w.Stats() for w in workers}
+
+
+class OutboundPublisher:
+    """
+    Hands outbound messages to paho from a single thread.
+    The queue is bounded: when it is full the oldest telemetry message
+    (device events) is dropped first. Other messages (command results,
+    sys/status, ...) are always sent before telemetry.
+    Messages are held back while the broker is unreachable and at most
+    max_inflight messages are handed to paho at a time.
+
+    Note: paho calls on_publish (-> Published) while holding its own
+    locks which publish() needs too, so publish() must not be called
+    while holding self.cond.
+    """
+
+    def __init__(self, client: mqtt.Client, max_queue: int, max_inflight: int):
+        self.client = client
+        self.max_queue = max_queue
+        self.max_inflight = max_inflight
+        self.cond = threading.Condition()
+        self.high: collections.deque = collections.deque()
+        self.telemetry: collections.deque = collections.deque()
+        # mids handed to paho which were not acknowledged yet
+        self.inflight: Set[int] = set()
+        # mids acknowledged before publish() returned
+        self.acked_early: Set[int] = set()
+        self.connected = False
+        self.published = 0
+        self.dropped_high = 0
+        self.dropped_telemetry = 0
+        self.thread = threading.Thread(
+            target=self._Run, name="mqtt-publisher", daemon=True)
+        self.thread.start()
+
+    def Put(self, topic: str, message, retain: bool, telemetry: bool):
+        with self.cond:
+            if len(self.high) + len(self.telemetry) >= self.max_queue:
+                if self.telemetry:
+                    self.telemetry.popleft()
+                    self.dropped_telemetry += 1
+                elif telemetry:
+                    self.dropped_telemetry += 1
+                    return
+                else:
+                    self.high.popleft()
+                    self.dropped_high += 1
+            (self.telemetry if telemetry else self.high).append(
+                (topic, message, retain))
+            self.cond.notify()
+
+    def SetConnected(self, connected: bool):
+        # inflight messages are kept: paho resends them after reconnecting
+        with self.cond:
+            self.connected = connected
+            self.cond.notify()
+
+    def Published(self, mid: int):
+        with self.cond:
+            if mid in self.inflight:
+                self.inflight.discard(mid)
+            else:
+                self.acked_early.add(mid)
+            self.cond.notify()
+
+    def _Ready(self) -> bool:
+        return (self.connected and len(self.inflight) < self.max_inflight and
+                bool(self.high or self.telemetry))
+
+    def _Run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(self._Ready)
+                queue = self.high if self.high else self.telemetry
+                topic, message, retain = queue.popleft()
+            priority = "telemetry" if queue is self.telemetry else "high"
+            info = self.client.publish(
+                topic, message, qos=MQTT_QOS, retain=retain)
+            with self.cond:
+                if info.rc == mqtt.MQTT_ERR_NO_CONN:
+                    # paho keeps the message and sends it after reconnecting,
+                    # hold back everything else until then
+                    logging.warning(f"publish while disconnected for {topic}")
+                    self.connected = False
+                elif info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logging.warning(f"publish failed for {topic}: {info.rc}")
+                    if queue is self.telemetry:
+                        self.dropped_telemetry += 1
+                    else:
+                        self.dropped_high += 1
+                    continue
+                if info.mid in self.acked_early:
+                    self.acked_early.discard(info.mid)
+                else:
+                    self.inflight.add(info.mid)
+                self.published += 1
+            METRICS.Inc("mqtt2cast_mqtt_published_total", (("priority", priority),))
+
+    def Stats(self) -> Dict[str, Any]:
+        return {"connected": self.connected,
+                "depth_high": len(self.high),
+                "depth_telemetry": len(self.telemetry),
+                "inflight": len(self.inflight),
+                "published": self.published,
+                "dropped_high": self.dropped_high,
+                "dropped_telemetry": self.dropped_telemetry}
+
+
+class TopicRouter:
+    """
+    Routes incoming messages by the topic segment following MESSAGE_PREFIX,
+    e.g. "action" for mqtt2cast/action/<target>/<action>.
+    This is a single dict lookup no matter how many actions and devices
+    there are.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        # kind -> (number of segments after kind, handler)
+        self.handlers: Dict[str, Tuple[int, Any]] = {}
+
+    def Register(self, kind: str, num_segments: int, handler):
+        """handler is called with the segments after kind and the payload"""
+        self.handlers[kind] = (num_segments, handler)
+
+    def Subscriptions(self) -> List[str]:
+        return [self.prefix + "/".join([kind] + ["+"] * n)
+                for kind, (n, _) in self.handlers.items()]
+
+    def Route(self, topic: str, payload: str) -> bool:
+        if not topic.startswith(self.prefix):
+            return False
+        kind, *segments = topic[len(self.prefix):].split("/")
+        num_segments, handler = self.handlers.get(kind, (-1, None))
+        if len(segments) != num_segments:
+            return False
+        handler(segments, payload)
+        return True
+
+
+def HandleActionTopic(segments: List[str], payload: str):
+    global COMMAND_DISPATCHER, CLUSTER
+    target, action = segments
+    cmd = ParseCommand(target, action, payload)
+    if CLUSTER and not CLUSTER.Handles(cmd):
+        logging.debug(f"not handled by this node: {cmd}")
+        return
+    COMMAND_DISPATCHER.Submit(cmd)
+
+
 class MqttClient:
 
-    def __init__(self, name, host, port, dispatcher: List = [Tuple[str, Any]]):
+    def __init__(self, name, host, port, router: TopicRouter):
         self.name = name
-        self.dispatcher = dispatcher
+        self.router = router
         self.client = mqtt.Client(name)
-        self.client.will_set(
-            f"{MESSAGE_PREFIX}sys/status", "0", retain=True)
+        # in cluster mode every node has its own status (and will)
+        self.status_topic = NodeTopic(f"{MESSAGE_PREFIX}sys/status")
+        self.client.will_set(self.status_topic, "0", retain=True)
+        self.client.max_inflight_messages_set(ARGS.mqtt_max_inflight)
+        self.publisher = OutboundPublisher(
+            self.client, ARGS.mqtt_queue_size, ARGS.mqtt_max_inflight)
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
         self.client.on_message = self.on_message
         self.client.on_log = self.on_log
         self.client.connect(host, port, keepalive=60)
@@ -375,13 +2623,27 @@ class MqttClient:
         print("!!!!!!!!!!!!!!!!!")
         log.error(f"paho problem {userdata} {level} {buff}")
 
-    def EmitMessage(self, topic, message, retain=True):
+    def EmitMessage(self, topic, message, retain=True, telemetry=False):
+        """
+        Does not block - the message is queued for the publisher thread.
+        Telemetry messages have lower priority and may be dropped.
+        """
         logging.info(f"MQTT {topic} {message}")
-        self.client.publish(topic, message, retain)
+        self.publisher.Put(topic, message, retain, telemetry)
 
     def EmitStatusMessage(self):
-        self.EmitMessage(
-            f"{MESSAGE_PREFIX}sys/status", "1", retain=True)
+        self.EmitMessage(self.status_topic, "1", retain=True)
+
+    # in its infinite wisdom, paho silently drops errors in callbacks
+    @exception
+    def on_disconnect(self, client, userdata, rc):
+        logging.warning(f"Disconnected with result code {rc}")
+        self.publisher.SetConnected(False)
+
+    # in its infinite wisdom, paho silently drops errors in callbacks
+    @exception
+    def on_publish(self, client, userdata, mid):
+        self.publisher.Published(mid)
 
     # in its infinite wisdom, paho silently drops errors in callbacks
     @exception
@@ -391,10 +2653,11 @@ class MqttClient:
             rc,
             userdata,
             dummy)
+        self.publisher.SetConnected(True)
         self.EmitStatusMessage()
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        for sub, _ in self.dispatcher:
+        for sub in self.router.Subscriptions():
             logging.info(f"subscribing to mqtt topic [{sub}]")
             self.client.subscribe(sub)
 
@@ -402,14 +2665,14 @@ class MqttClient:
     @exception
     def on_message(self, client, userdata, msg):
         """allback for when a PUBLISH message is received from the server"""
+        global RECORDER
         logging.info(f"received: {msg.topic} {msg.payload}")
+        METRICS.Inc("mqtt2cast_mqtt_received_total")
         try:
-            for sub, action in self.dispatcher:
-                if mqtt.topic_matches_sub(sub, msg.topic):
-                    logging.info("match: {sub} for {msg.topic} {msg.payload}")
-                    action(msg.topic.split("/"), msg.payload.decode("utf-8"))
-                    break
-            else:
+            payload = msg.payload.decode("utf-8")
+            if RECORDER:
+                RECORDER.Record("mqtt", msg.topic, payload)
+            if not self.router.Route(msg.topic, payload):
                 logging.warning("message did no match")
         except Exception as err:
             logging.error(f"failure: {type(err)} {err}")
@@ -440,33 +2703,320 @@ def GetM3uSongs(data):
 
 PLAYLIST_MIMETYPES = ["audio/x-mpegurl"]
 
+EXTENSION_MIMETYPES = [("aac", "audio/aac"),
+                       ("wav", "audio/wav"),
+                       ("flac", "audio/flac"),
+                       ("mp3", "audio/mpeg")]
+
+HTTP_TIMEOUT = 5.0
+
+
+class TtlCache:
+    """
+    Thread safe LRU cache. Entries older than ttl seconds are
+    reported as stale so the caller can revalidate them.
+    With a directory entries are also persisted (at most max_entries
+    files, the least recently used are deleted).
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: float, directory: str = ""):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = os.path.expanduser(directory)
+        self.lock = threading.Lock()
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        # key -> Future of a Load() in progress
+        self.loading: Dict[str, concurrent.futures.Future] = {}
+        # persisted files, least recently used first
+        self.files: collections.OrderedDict = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            paths = [os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                     if f.endswith(".json")]
+            for path in sorted(paths, key=os.path.getmtime):
+                self.files[path] = None
+            self._Evict([])
+
+    def _DiskPath(self, key: str) -> str:
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _Fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["fetched"] < self.ttl
+
+    def _Evict(self, victims: List[str]):
+        """must hold self.lock (or be in __init__), deletes excess files"""
+        while len(self.files) > self.max_entries:
+            victims.append(self.files.popitem(last=False)[0])
+        for path in victims:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def Get(self, key: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """Returns (entry, is_fresh)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None and self.directory:
+            path = self._DiskPath(key)
+            try:
+                with open(path) as fp:
+                    entry = json.load(fp)
+            except (OSError, ValueError):
+                pass
+            if entry is not None:
+                with self.lock:
+                    # keep it in memory so we do not read the file again
+                    self.entries.setdefault(key, entry)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+                    if path in self.files:
+                        self.files.move_to_end(path)
+        if entry is None:
+            return None, False
+        return entry, self._Fresh(entry)
+
+    def Put(self, key: str, entry: Dict[str, Any]):
+        entry["fetched"] = time.time()
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if self.directory:
+            path = self._DiskPath(key)
+            try:
+                with open(path, "w") as fp:
+                    json.dump(entry, fp)
+            except OSError as err:
+                logging.warning(f"cannot persist {self.name} entry for {key}: {err}")
+                return
+            with self.lock:
+                self.files[path] = None
+                self.files.move_to_end(path)
+                self._Evict([])
+
+    def Load(self, key: str, load) -> Dict[str, Any]:
+        """
+        Returns a fresh entry for key. Otherwise load(stale entry or None)
+        produces it, returning the stale entry means it was revalidated.
+        Concurrent calls for the same key share a single load.
+        """
+        entry, fresh = self.Get(key)
+        with self.lock:
+            if not fresh:
+                # somebody may have loaded it meanwhile
+                entry = self.entries.get(key, entry)
+                fresh = entry is not None and self._Fresh(entry)
+            if fresh and entry is not None:
+                self.hits += 1
+                return entry
+            future = self.loading.get(key)
+            loader = future is None
+            if loader:
+                future = concurrent.futures.Future()
+                self.loading[key] = future
+            else:
+                self.hits += 1
+        if not loader:
+            return future.result()
+        try:
+            result = load(entry)
+            self.Put(key, result)
+            with self.lock:
+                if entry is not None and result is entry:
+                    self.revalidated += 1
+                else:
+                    self.misses += 1
+            future.set_result(result)
+            return result
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self.lock:
+                del self.loading[key]
+
+    def Stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "files": len(self.files),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "revalidated": self.revalidated}
+
+
+def FetchPlaylist(url: str, parser) -> List[str]:
+    """
+    Returns the songs of a playlist using PLAYLIST_CACHE.
+    Stale entries are revalidated with ETag/Last-Modified.
+    """
+    global PLAYLIST_CACHE
+
+    def load(entry: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+                data = response.read()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except urllib.error.HTTPError as err:
+            if err.code != 304 or not entry:
+                raise
+            return entry
+        return {"songs": parser(data),
+                "etag": etag,
+                "last_modified": last_modified}
+
+    return PLAYLIST_CACHE.Load(url, load)["songs"]
+
 
 def GetSongs(url, mime_type):
     global URL_MAP
     # if url.startswith("@"):
     #    return [URL_MAP[url[1:]]]
-    print("#########", mime_type)
     if mime_type and mime_type not in PLAYLIST_MIMETYPES:
-        return [songs]
+        return [url]
 
     if url.endswith("pls"):
-        data = urllib.request.urlopen(url).read()
-        return GetPlsSongs(data)
+        return FetchPlaylist(url, GetPlsSongs)
     elif url.endswith("m3u"):
-        data = urllib.request.urlopen(url).read()
-        return GetM3uSongs(data)
+        return FetchPlaylist(url, GetM3uSongs)
     else:
         return [url]
 
 
-def PlayMediaWrapper(topic: List[str], payload: str):
-    global CAST_DEVICES
-    token = payload.split()
-    host = topic[-2]
+def GetMimeType(url: str, probe: bool = True) -> str:
+    """
+    Guesses the mime type from the extension and otherwise asks the
+    server (unless probe is False). Results are kept in MIME_TYPE_CACHE.
+    """
+    global MIME_TYPE_CACHE
+    for ext, mime_type in EXTENSION_MIMETYPES:
+        if url.endswith(ext):
+            return mime_type
+    if not probe:
+        entry, _ = MIME_TYPE_CACHE.Get(url)
+        return entry["mime_type"] if entry else "audio/mpeg"
+
+    def load(entry: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        mime_type = "audio/mpeg"
+        try:
+            request = urllib.request.Request(url, method="HEAD")
+            with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+                content_type = response.headers.get_content_type()
+            if content_type.startswith(("audio/", "video/", "image/")):
+                mime_type = content_type
+        except Exception as err:
+            logging.info(f"cannot determine mime type of {url}: {err}")
+        return {"mime_type": mime_type}
+
+    return MIME_TYPE_CACHE.Load(url, load)["mime_type"]
+
+
+def GetMimeTypes(songs: List[str]) -> List[Tuple[str, str]]:
+    """
+    Returns (url, mime type) for the songs. Only the first song may
+    cost a request to the server, the others are guessed so long
+    playlists start without a round trip per song.
+    """
+    return [(song, GetMimeType(song, probe=(i == 0))) for i, song in enumerate(songs)]
+
+
+def _TimedCall(function, cast, timing: Optional[CommandTiming]) -> float:
+    start = time.monotonic()
+    previous = getattr(COMMAND_CONTEXT, "timing", None)
+    COMMAND_CONTEXT.timing = timing
+    try:
+        function(cast)
+    finally:
+        COMMAND_CONTEXT.timing = previous
+    return time.monotonic() - start
+
+
+def RunOnCasts(host: str, action: str, function):
+    """
+    Runs function(cast) for every device matching host, always on the
+    worker of the device (see CommandDispatcher.Call) so it is ordered
+    with the other commands for the device.
+    Broadcasts (empty host or several matching devices) run concurrently
+    with a per device timeout and publish one aggregated outcome message.
+    Calls still queued at the timeout are cancelled. Devices with a call
+    which timed out while running are skipped until it returns so
+    broadcasts do not pile up behind a hung device.
+    """
+    global CAST_DEVICES, MQTT_CLIENT, COMMAND_DISPATCHER, CLUSTER
+    casts = CAST_DEVICES.GetCasts(host)
+    if not casts:
+        if CLUSTER:
+            CLUSTER.CheckRemote(host)
+        # makes the command fail instead of reporting success
+        raise LookupError(f"unknown device [{host}]")
+    timing = getattr(COMMAND_CONTEXT, "timing", None)
+    if host and len(casts) == 1:
+        cast = casts[0]
+        COMMAND_DISPATCHER.Call(
+            cast.host, functools.partial(_TimedCall, function, cast, timing)).result()
+        return
+
+    busy = [cast for cast in casts
+            if cast.late_call is not None and not cast.late_call.done()]
+    start = time.monotonic()
+    deadline = start + ARGS.broadcast_timeout
+    futures = [(cast, COMMAND_DISPATCHER.Call(
+                    cast.host, functools.partial(_TimedCall, function, cast, timing)))
+               for cast in casts if cast not in busy]
+    results = {cast.name: {"ok": False, "error": "busy with a timed out call"}
+               for cast in busy}
+    for cast, future in futures:
+        try:
+            latency = future.result(
+                timeout=max(0.0, deadline - time.monotonic()))
+            results[cast.name] = {"ok": True, "latency": round(latency, 3)}
+        except concurrent.futures.TimeoutError:
+            if not future.cancel():
+                # the call keeps running, remember it so the device is
+                # skipped until it returns
+                cast.late_call = future
+            results[cast.name] = {"ok": False, "error": "timeout"}
+        except Exception as err:
+            results[cast.name] = {"ok": False, "error": f"{type(err).__name__}: {err}"}
+    outcome = {"action": action,
+               "target": host,
+               "ok": sum(1 for r in results.values() if r["ok"]),
+               "failed": sum(1 for r in results.values() if not r["ok"]),
+               "duration": round(time.monotonic() - start, 3),
+               "devices": results}
+    logging.info(f"broadcast {action} [{host}]: {outcome['ok']} ok {outcome['failed']} failed")
+    if timing and outcome["failed"]:
+        timing.errors += [f"{name}: {r['error']}" for name, r in results.items() if not r["ok"]]
+    MQTT_CLIENT.EmitMessage(
+        NodeTopic(f"{MESSAGE_PREFIX}broadcast/{action}"), json.dumps(outcome), retain=False)
+
+
+def PlayMediaWrapper(cmd: Command):
+    token = cmd.payload.split()
+    host = cmd.target
     url = token[0]
     mime_type = token[1] if len(token) > 1 else ""
     logging.info(f"PlayMediaWrapper {host} {url} {mime_type}")
-    songs = GetSongs(url, mime_type)
+    with TimingPhase("resolve"):
+        songs = GetSongs(url, mime_type)
+        items = GetMimeTypes(songs)
     # songs = [
     #     "https://www.bensound.com/bensound-music/bensound-jazzyfrenchy.mp3",
     #     "https://audio.guim.co.uk/2020/08/14-65292-200817TIFXR.mp3",
@@ -475,37 +3025,26 @@ def PlayMediaWrapper(topic: List[str], payload: str):
     #     "http://ice4.somafm.com/lush-128-aac",
     # ]
     logging.info("Songs [%s]: %s", url, songs)
-    for n, song in enumerate(songs):
-        if song.endswith("aac"):
-            mime_type = "audio/aac"
-        elif song.endswith("wav"):
-            mime_type = "audio/wav"
-        elif song.endswith("flac"):
-            mime_type = "audio/flac"
+
+    def play(cast):
+        if len(items) == 1:
+            cast.PlayMedia(items[0][0], mime_type=items[0][1], enqueue=False)
         else:
-            mime_type = "audio/mpeg"
+            cast.PlayPlaylist(items)
 
-        for cast in CAST_DEVICES.GetCasts(host):
-            if n == 0:
-                cast.PlayMedia(song, mime_type=mime_type, enqueue=False)
-            else:
-                cast.PlayMedia(song, mime_type=mime_type, enqueue=True)
-            time.sleep(.2)
+    RunOnCasts(host, "play_media", play)
 
 
-def PlayYoutubeWrapper(topic: List[str], video_id: str):
-    global CAST_DEVICES
-    host = topic[-2]
+def PlayYoutubeWrapper(cmd: Command):
+    host = cmd.target
+    video_id = cmd.payload
     logging.info(f"PlayYoutubeWrapper {host} {video_id}")
-    for cast in CAST_DEVICES.GetCasts(host):
-        cast.PlayYoutube(video_id)
+    RunOnCasts(host, "play_youtube", lambda cast: cast.PlayYoutube(video_id))
 
 
-def StopMediaWrapper(topic: List[str], payload: str):
-    global CAST_DEVICES
-    host = topic[-2]
-    for cast in CAST_DEVICES.GetCasts(host):
-        cast.PlayMedia("")
+def StopMediaWrapper(cmd: Command):
+    host = cmd.target
+    RunOnCasts(host, "stop_media", lambda cast: cast.PlayMedia(""))
 
 
 # def PlayAlarmWrapper(topic: List[str], payload: str):
@@ -516,42 +3055,196 @@ def StopMediaWrapper(topic: List[str], payload: str):
 #     PlayRadioWrapper(topic, payload)
 
 
-def LoadUrlWrapper(topic: List[str], url: str):
-    global CAST_DEVICES
-    host = topic[-2]
-    for cast in CAST_DEVICES.GetCasts(host):
-        cast.LoadUrl(url)
+def LoadUrlWrapper(cmd: Command):
+    host = cmd.target
+    url = cmd.payload
+    RunOnCasts(host, "load_url", lambda cast: cast.LoadUrl(url))
 
 
-def SetVolumeWrapper(topic: List[str], level: str):
-    global CAST_DEVICES
-    host = topic[-2]
-    level = float(level)
-    for cast in CAST_DEVICES.GetCasts(host):
-        cast.SetVolume(level)
+def SetVolumeWrapper(cmd: Command):
+    host = cmd.target
+    level = float(cmd.payload)
+    RunOnCasts(host, "set_volume", lambda cast: cast.SetVolume(level))
 
 
-def QueueNextWrapper(topic: List[str], dummy: str):
-    global CAST_DEVICES
-    host = topic[-2]
-    for cast in CAST_DEVICES.GetCasts(host):
-        cast.QueueNext()
+def QueueNextWrapper(cmd: Command):
+    host = cmd.target
+    RunOnCasts(host, "queue_next", lambda cast: cast.QueueNext())
+
 
+def QuitAppWrapper(cmd: Command):
+    host = cmd.target
+    RunOnCasts(host, "quit_app", lambda cast: cast.QuitApp())
 
-def QuitAppWrapper(topic: List[str], payload: str):
+
+def RescanDevices(cmd: Command):
     global CAST_DEVICES
-    host = topic[-2]
-    for cast in CAST_DEVICES.GetCasts(host):
-        cast.QuitApp()
+    CAST_DEVICES.Rescan()
 
 
-def RescanDevices(topic: List[str], payload: str):
+class SyncMember:
+    """
+    A device taking part in a synchronized start (see PlayMediaSyncWrapper).
+    Preparing the media and sending play both run on the worker of the
+    device, in order with its other commands.
+    """
+
+    def __init__(self, cast: CastDeviceWrapper, items):
+        global COMMAND_DISPATCHER
+        self.cast = cast
+        self.items = items
+        # set when the device did not get ready in time
+        self.skip = False
+        self.prepare_duration = 0.0
+        self.play_sent = 0.0
+        self.error = ""
+        self.prepared = COMMAND_DISPATCHER.Call(cast.host, self._Prepare)
+        self.played: Optional[concurrent.futures.Future] = None
+
+    def _Prepare(self):
+        start = time.monotonic()
+        try:
+            self.cast.PrepareMedia(self.items)
+        finally:
+            self.prepare_duration = time.monotonic() - start
+
+    def Play(self):
+        global COMMAND_DISPATCHER
+        self.played = COMMAND_DISPATCHER.Call(self.cast.host, self._Play)
+
+    def _Play(self):
+        self.play_sent = time.monotonic()
+        self.cast.Play()
+
+
+def PlayMediaSyncWrapper(cmd: Command):
+    """
+    Starts the media on all devices of the target at the same time:
+    the media is loaded paused on all devices in parallel (on their
+    workers) and play is sent once every device has buffered it (or
+    --sync_timeout passed).
+    The start offsets derived from the media status updates are
+    published on mqtt2cast/sync/<target>.
+    """
+    global CAST_DEVICES, MQTT_CLIENT, CLUSTER
+    token = cmd.payload.split()
+    url = token[0]
+    mime_type = token[1] if len(token) > 1 else ""
+    with TimingPhase("resolve"):
+        songs = GetSongs(url, mime_type)
+        items = GetMimeTypes(songs)
+    casts = CAST_DEVICES.GetCasts(cmd.target)
+    if not casts:
+        if CLUSTER:
+            CLUSTER.CheckRemote(cmd.target)
+        raise LookupError(f"unknown device [{cmd.target}]")
+    start = time.monotonic()
+    deadline = start + ARGS.sync_timeout
+    with TimingPhase("prepare"):
+        members = [SyncMember(cast, items) for cast in casts]
+        for m in members:
+            try:
+                m.prepared.result(max(0.0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError:
+                m.prepared.cancel()
+                m.skip = True
+                m.error = "prepare timeout"
+            except Exception as err:
+                m.skip = True
+                m.error = f"{type(err).__name__}: {err}"
+    with TimingPhase("send"):
+        for m in members:
+            if not m.skip:
+                m.Play()
+        for m in members:
+            if m.played is None:
+                continue
+            try:
+                m.played.result(max(0.0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError:
+                m.error = "play timeout"
+            except Exception as err:
+                m.error = f"{type(err).__name__}: {err}"
+    started = {}
+    with TimingPhase("active"):
+        for m in members:
+            if m.skip or m.error:
+                continue
+            playing = m.cast.WaitForPlayerState(
+                ("PLAYING",), m.play_sent, max(0.0, deadline - time.monotonic()))
+            if playing is None:
+                m.error = "did not start playing"
+                continue
+            arrival, position = playing
+            # when the device started at position 0 according to its status
+            started[m.cast.name] = arrival - position
+    first_play = min((m.play_sent for m in members if m.play_sent), default=0.0)
+    first_start = min(started.values(), default=0.0)
+    report = {"target": cmd.target,
+              "url": url,
+              "prepared": sum(1 for m in members if not m.skip),
+              "started": len(started),
+              "skew": round(max(started.values()) - first_start, 3) if started else None,
+              "duration": round(time.monotonic() - start, 3),
+              "members": {m.cast.name: {
+                  "prepare": round(m.prepare_duration, 3),
+                  "play_sent": round(m.play_sent - first_play, 3) if m.play_sent else None,
+                  "start_offset": (round(started[m.cast.name] - first_start, 3)
+                                   if m.cast.name in started else None),
+                  "error": m.error} for m in members}}
+    logging.info(f"sync start [{cmd.target}]: {report['started']}/{len(members)} "
+                 f"devices, skew {report['skew']}")
+    timing = getattr(COMMAND_CONTEXT, "timing", None)
+    if timing:
+        timing.errors += [f"{m.cast.name}: {m.error}" for m in members if m.error]
+    MQTT_CLIENT.EmitMessage(
+        NodeTopic(f"{MESSAGE_PREFIX}sync/{cmd.target}"), json.dumps(report), retain=False)
+
+
+def HandleQueryTopic(segments: List[str], payload: str):
+    """
+    mqtt2cast/query/<device>/<field> (field "all" for every field) is
+    answered on mqtt2cast/state/<device>/<field> from DeviceState.
+    The payload may contain a correlation id which is echoed.
+    """
+    global CAST_DEVICES, CLUSTER, MQTT_CLIENT
+    device, field = segments
+    casts = CAST_DEVICES._LookupCasts(device)
+    if not casts and CLUSTER:
+        # most likely owned by another node
+        return
+    reply: Dict[str, Any] = {"device": device, "field": field}
+    cmd = ParseCommand(device, "query", payload)
+    if cmd.id:
+        reply["id"] = cmd.id
+    if len(casts) != 1:
+        reply["error"] = "unknown device" if not casts else "ambiguous device"
+    elif field == "all":
+        reply["state"] = casts[0].state.Snapshot()
+    else:
+        entry = casts[0].state.Get(field)
+        if entry is None:
+            reply["error"] = "unknown field"
+        else:
+            reply.update(entry)
+    MQTT_CLIENT.EmitMessage(f"{MESSAGE_PREFIX}state/{device}/{field}",
+                            json.dumps(reply, default=str), retain=False)
+
+
+def HandleGroupTopic(segments: List[str], payload: str):
+    """
+    mqtt2cast/group/<name> with a comma separated list of members
+    defines a group, an empty payload deletes it
+    """
     global CAST_DEVICES
-    CAST_DEVICES.UpdateCastDevices()
+    name, = segments
+    members = [m.strip() for m in payload.split(",") if m.strip()]
+    CAST_DEVICES.SetGroup(name, members)
 
 
 ACTION_MAP = {"rescan":  RescanDevices,
               "play_media": PlayMediaWrapper,
+              "play_media_sync": PlayMediaSyncWrapper,
               # "play_youtube": PlayYoutubeWrapper,
               "stop_media": StopMediaWrapper,
               "load_url": LoadUrlWrapper,
@@ -560,32 +3253,72 @@ ACTION_MAP = {"rescan":  RescanDevices,
               "quit_app": QuitAppWrapper,
               }
 
-DISPATCH = [(f"{MESSAGE_PREFIX}action/+/{key}", val)
-            for key, val in ACTION_MAP.items()]
+ROUTER = TopicRouter(MESSAGE_PREFIX)
+ROUTER.Register("action", 2, HandleActionTopic)
+ROUTER.Register("group", 1, HandleGroupTopic)
+ROUTER.Register("query", 2, HandleQueryTopic)
 # ("/mqtt2cast/action/alarm/#", PlayAlarmWrapper),
 
 
+def BenchRouter():
+    """
+    Compares the per message cost of the old linear topic_matches_sub
+    scan over all actions with the TopicRouter.
+    """
+    rounds = 20000
+    for num_actions in [len(ACTION_MAP), 50, 200]:
+        actions = list(ACTION_MAP.keys()) + [f"action{i}" for i in range(num_actions - len(ACTION_MAP))]
+        linear = [(f"{MESSAGE_PREFIX}action/+/{a}", a) for a in actions]
+        router = TopicRouter(MESSAGE_PREFIX)
+        router.Register("action", 2, lambda segments, payload: None)
+        # worst case for the linear scan: the last registered action
+        topics = [f"{MESSAGE_PREFIX}action/device{i % 100}/{actions[-1]}" for i in range(rounds)]
+        start = time.perf_counter()
+        for topic in topics:
+            for sub, action in linear:
+                if mqtt.topic_matches_sub(sub, topic):
+                    topic.split("/")
+                    break
+        t_linear = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for topic in topics:
+            router.Route(topic, "")
+        t_router = (time.perf_counter() - start) / rounds
+        print(f"actions: {num_actions:4d}  linear: {t_linear * 1e6:8.2f}us/msg  router: {t_router * 1e6:6.2f}us/msg")
+
+
 ############################################################
 
+def CollectStats() -> Dict[str, Any]:
+    global COMMAND_DISPATCHER, PLAYLIST_CACHE, MIME_TYPE_CACHE, EVENT_PUBLISHER, MQTT_CLIENT
+    return {"queues": COMMAND_DISPATCHER.Stats(),
+            "playlist_cache": PLAYLIST_CACHE.Stats(),
+            "mime_type_cache": MIME_TYPE_CACHE.Stats(),
+            "events": EVENT_PUBLISHER.Stats(),
+            "mqtt_publisher": MQTT_CLIENT.publisher.Stats(),
+            "event_stream": EVENT_STREAM.Stats(),
+            "history": HISTORY_STORE.Stats(),
+            "connection_pool": CAST_DEVICES.pool.Stats() if CAST_DEVICES.pool else None,
+            "cluster": CLUSTER.Stats() if CLUSTER else None,
+            "recorder": RECORDER.Stats() if RECORDER else None,
+            "last_scan": CAST_DEVICES.last_scan}
+
+
 def RenderStatusPage(history_log, cast_devices):
     global HTML_PROLOG, HTML_EPILOG
-    html = ["<table border=1>"]
+    html = ["<table border=1 id=history>"]
     last = None
-    for host, kind in sorted(history_log.keys()):
-        cast = cast_devices.host_map[host]
-        timestamp, data = history_log[(host, kind)]
+    for (host, kind), (timestamp, data) in sorted(dict(history_log).items(), key=lambda x: x[0]):
+        cast = cast_devices.host_map.get(host)
         if host != last:
-            html.append(f"<tr><th colspan=3>{host} {cast.name}</th></tr>")
+            html.append(f"<tr id='host|{host}'><th colspan=3>{host} {cast.name if cast else '(gone)'}</th></tr>")
             last = host
 
-        content = [str(type(data))]
-        for k, v in sorted(PruneDict(ObjToDict(data)).items()):
-            content.append("%s: %s" % (k, repr(v)))
         html.append(
-            "<tr><td>%s</td><td><pre>%s</pre></td><td><pre>%s</pre></td></tr>" %
-            (kind, timestamp, HtmlCleanup(
-                "\n".join(content))))
-    html += ["</table>"]
+            "<tr id='%s' data-host='%s'><td>%s</td><td><pre>%s</pre></td><td><pre>%s</pre></td></tr>" %
+            (HtmlCleanup(f"{host}|{kind}"), host, kind, timestamp, HtmlCleanup(
+                HistoryContent(data))))
+    html += ["</table>", STATUS_PAGE_SCRIPT]
     html += ["<hr>",
              "<pre>",
              "Note the devices and actions listed below also reflect the available mqtt commands, e.g.:",
@@ -595,6 +3328,7 @@ def RenderStatusPage(history_log, cast_devices):
 
     html += ["<select name=device>"]
     html += [f"<option value='{name}'>{name}</option>" for name in cast_devices.name_map.keys()]
+    html += [f"<option value='{name}'>{name} (group)</option>" for name in cast_devices.groups.keys()]
     html += ["</select>"]
 
     html += ["<select name=action>"]
@@ -605,18 +3339,347 @@ def RenderStatusPage(history_log, cast_devices):
              "<input type=submit value=Send>",
              "</form>"]
 
+    stats = CollectStats()
+    if stats["last_scan"]:
+        html += ["<hr>", "<pre>", "last subnet scan: %s" % HtmlCleanup(
+            json.dumps(stats["last_scan"])), "</pre>"]
+
+    html += ["<hr>", "<pre>"]
+    for key in ["playlist_cache", "mime_type_cache", "events", "mqtt_publisher", "event_stream", "history"]:
+        html.append("%s: %s" % (key, json.dumps(stats[key])))
+    html += ["</pre>"]
+
+    html += ["<hr>", "<table border=1>",
+             "<tr><th>queue</th><th>depth</th><th>processed</th><th>dropped</th><th>coalesced</th><th>last wait</th><th>max wait</th></tr>"]
+    for key, q in sorted(stats["queues"].items()):
+        html.append("<tr><td>%s</td><td>%d</td><td>%d</td><td>%d</td><td>%d</td><td>%.3fs</td><td>%.3fs</td></tr>" % (
+            HtmlCleanup(key or "(all)"), q["depth"], q["processed"], q["dropped"],
+            q["coalesced"], q["last_wait"], q["max_wait"]))
+    html += ["</table>"]
+
     return HTML_PROLOG + "\n".join(html) + HTML_EPILOG
 
 
+def RenderStatusJson(history_log, cast_devices) -> str:
+    devices: Dict[str, Any] = {}
+    for (host, kind), (timestamp, data) in sorted(dict(history_log).items(), key=lambda x: x[0]):
+        cast = cast_devices.host_map.get(host)
+        device = devices.setdefault(host, {"name": cast.name if cast else None,
+                                           "events": {}})
+        device["events"][kind] = {"time": timestamp,
+                                  "data": PruneDict(SerializeObject(data))}
+    return json.dumps({"devices": devices,
+                       "groups": cast_devices.groups,
+                       "actions": list(ACTION_MAP.keys()),
+                       "stats": CollectStats()}, cls=ComplexEncoder)
+
+
+class StatusCache:
+    """
+    Caches the rendered status page and json.
+    A rendering is reused while HISTORY_GENERATION is unchanged, but no
+    longer than max_age seconds since it also contains live statistics.
+    """
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # path -> (generation, render time, etag, body)
+        self.entries: Dict[str, Tuple[int, float, str, bytes]] = {}
+        self.renders = 0
+        self.hits = 0
+
+    def Get(self, path: str, render) -> Tuple[str, bytes]:
+        global HISTORY_GENERATION
+        with self.lock:
+            generation = HISTORY_GENERATION
+            now = time.monotonic()
+            entry = self.entries.get(path)
+            if entry and entry[0] == generation and now - entry[1] < self.max_age:
+                self.hits += 1
+                return entry[2], entry[3]
+            body = bytes(render(), "utf-8")
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            self.entries[path] = (generation, now, etag, body)
+            self.renders += 1
+            return etag, body
+
+
+STATUS_CACHE = StatusCache(1.0)
+
+
+def CollectGauges() -> List[Tuple[str, Labels, float]]:
+    global MQTT_CLIENT, COMMAND_DISPATCHER, CAST_DEVICES
+    out: List[Tuple[str, Labels, float]] = []
+    if MQTT_CLIENT:
+        stats = MQTT_CLIENT.publisher.Stats()
+        out.append(("mqtt2cast_mqtt_outbound_queue_depth",
+                    (("priority", "high"),), stats["depth_high"]))
+        out.append(("mqtt2cast_mqtt_outbound_queue_depth",
+                    (("priority", "telemetry"),), stats["depth_telemetry"]))
+    if COMMAND_DISPATCHER:
+        for key, stats in COMMAND_DISPATCHER.Stats().items():
+            out.append(("mqtt2cast_command_queue_depth",
+                        (("queue", key),), stats["depth"]))
+    if CAST_DEVICES:
+        for host, cast in list(CAST_DEVICES.host_map.items()):
+            out.append(("mqtt2cast_device_connected",
+                        (("device", cast.name), ("host", host)), int(cast.IsConnected())))
+        if CAST_DEVICES.pool:
+            stats = CAST_DEVICES.pool.Stats()
+            out.append(("mqtt2cast_connection_pool_size",
+                        (("pinned", "false"),), stats["open"]))
+            out.append(("mqtt2cast_connection_pool_size",
+                        (("pinned", "true"),), stats["pinned"]))
+    return out
+
+
+METRICS.AddCollector(CollectGauges)
+
+
+############################################################
+# Debugging
+# Thread dumps, a sampling profiler and the slow command log.
+# None of this runs unless enabled with --debug_endpoints or
+# --slow_command_ms.
+############################################################
+SLOW_COMMANDS: collections.deque = collections.deque(maxlen=100)
+PROFILE_LOCK = threading.Lock()
+PROFILE_MAX_SECONDS = 60.0
+PROFILE_INTERVAL = 0.005
+
+
+def LogSlowCommand(cmd: Command, result: str, wait: float, duration: float,
+                   timing: CommandTiming):
+    entry = {"time": time.strftime("%y/%m/%d %H:%M:%S"),
+             "target": cmd.target,
+             "action": cmd.action,
+             "payload": cmd.payload,
+             "result": result,
+             "queue": round(wait, 3),
+             "duration": round(duration, 3),
+             "timing": timing.Report()}
+    SLOW_COMMANDS.append(entry)
+    logging.warning(f"slow command: {entry}")
+
+
+def DumpThreads() -> str:
+    frames = sys._current_frames()
+    out = []
+    for thread in sorted(threading.enumerate(), key=lambda t: t.name):
+        out.append(f"{thread.name} ident={thread.ident} daemon={thread.daemon}")
+        frame = frames.get(thread.ident) if thread.ident is not None else None
+        if frame is not None:
+            out += [line.rstrip() for line in traceback.format_stack(frame)]
+        out.append("")
+    return "\n".join(out)
+
+
+def _FrameKey(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def SampleProfile(seconds: float, interval: float = PROFILE_INTERVAL) -> str:
+    """
+    Samples the stacks of all threads (cProfile would only see the
+    thread running it). Reports per function how often it was on
+    the stack (cumulative) and at the top of the stack (self).
+    """
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    cumulative: collections.Counter = collections.Counter()
+    own: collections.Counter = collections.Counter()
+    per_thread: collections.Counter = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, top in sys._current_frames().items():
+            if ident == me:
+                continue
+            thread = names.get(ident, str(ident))
+            own[(thread, _FrameKey(top))] += 1
+            seen = set()
+            frame: Optional[types.FrameType] = top
+            while frame is not None:
+                key = (thread, _FrameKey(frame))
+                if key not in seen:
+                    seen.add(key)
+                    cumulative[key] += 1
+                frame = frame.f_back
+            per_thread[thread] += 1
+        samples += 1
+        time.sleep(interval)
+    out = [f"{samples} samples over {seconds}s every {interval * 1000:.0f}ms", "",
+           "samples per thread:"]
+    out += [f"{n:8d}  {thread}" for thread, n in per_thread.most_common()]
+    # idle threads waiting on a lock or socket dominate "self",
+    # so both views are shown
+    for title, counter in (("self", own), ("cumulative", cumulative)):
+        out += ["", f"top functions ({title}):", f"{'samples':>8}  {'%':>6}  thread / function"]
+        for (thread, key), n in counter.most_common(50):
+            out.append(f"{n:8d}  {100.0 * n / max(1, samples):6.1f}  {thread} / {key}")
+    return "\n".join(out)
+
+
+# seconds between comments sent to idle /events clients
+SSE_KEEPALIVE = 15.0
+
+
 class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
 
     def do_GET(self):
-        print("GET", self.path)
-        global HISTORY_LOG, CAST_DEVICES
+        global HISTORY_LOG, CAST_DEVICES, STATUS_CACHE
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/":
+            content_type = "text/html; charset=utf-8"
+            etag, body = STATUS_CACHE.Get(
+                path, lambda: RenderStatusPage(HISTORY_LOG, CAST_DEVICES))
+        elif path == "/events":
+            self.ServeEvents()
+            return
+        elif path == "/ready":
+            body = bytes(json.dumps(STARTUP.Status()), "utf-8")
+            self.send_response(200 if STARTUP.ready else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif path == "/metrics":
+            content_type = "text/plain; version=0.0.4"
+            body = bytes(METRICS.Render(), "utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif path == "/api/history":
+            self.ServeHistory()
+            return
+        elif path == "/api/state":
+            self.ServeState()
+            return
+        elif path == "/api/status":
+            content_type = "application/json"
+            etag, body = STATUS_CACHE.Get(
+                path, lambda: RenderStatusJson(HISTORY_LOG, CAST_DEVICES))
+        elif path.startswith("/debug/") and ARGS.debug_endpoints:
+            self.ServeDebug(path)
+            return
+        else:
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def ServeHistory(self):
+        """/api/history?device=NAME_OR_IP&since=EPOCH_SECONDS&kind=KIND"""
+        global HISTORY_STORE, CAST_DEVICES
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        device = query.get("device", [""])[0]
+        kind = query.get("kind", [""])[0]
+        try:
+            since = float(query.get("since", ["0"])[0])
+        except ValueError:
+            self.send_error(400, "bad since")
+            return
+        if not device:
+            hosts = list(HISTORY_STORE.devices.keys())
+        elif device in CAST_DEVICES.name_map:
+            hosts = [CAST_DEVICES.name_map[device].host]
+        else:
+            hosts = [device]
+        body = bytes(HISTORY_STORE.QueryJson(hosts, since, kind), "utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def ServeDebug(self, path: str):
+        """/debug/threads, /debug/profile?seconds=N and /debug/slow"""
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        content_type = "text/plain; charset=utf-8"
+        if path == "/debug/threads":
+            text = DumpThreads()
+        elif path == "/debug/profile":
+            try:
+                seconds = float(query.get("seconds", ["5"])[0])
+            except ValueError:
+                self.send_error(400, "bad seconds")
+                return
+            if not 0 < seconds <= PROFILE_MAX_SECONDS:
+                self.send_error(400, f"seconds must be in (0, {PROFILE_MAX_SECONDS}]")
+                return
+            if not PROFILE_LOCK.acquire(blocking=False):
+                self.send_error(409, "profile already running")
+                return
+            try:
+                text = SampleProfile(seconds)
+            finally:
+                PROFILE_LOCK.release()
+        elif path == "/debug/slow":
+            content_type = "application/json"
+            text = json.dumps(list(SLOW_COMMANDS), cls=ComplexEncoder)
+        else:
+            self.send_error(404)
+            return
+        body = bytes(text, "utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def ServeState(self):
+        """/api/state?device=NAME_OR_IP"""
+        global CAST_DEVICES
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        device = query.get("device", [""])[0]
+        casts = CAST_DEVICES._ResolveCasts(device)
+        body = bytes(json.dumps({cast.name: {"host": cast.host,
+                                             "connected": cast.IsConnected(),
+                                             "state": cast.state.Snapshot()}
+                                 for cast in casts}, default=str), "utf-8")
         self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(bytes(RenderStatusPage(
-            HISTORY_LOG, CAST_DEVICES), "utf-8"))
+        self.wfile.write(body)
+
+    def ServeEvents(self):
+        global EVENT_STREAM
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        client = EVENT_STREAM.Connect()
+        try:
+            while not client.dropped:
+                try:
+                    data = client.queue.get(timeout=SSE_KEEPALIVE)
+                    self.wfile.write(bytes(f"data: {data}\n\n", "utf-8"))
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            EVENT_STREAM.Disconnect(client)
+
+    def log_message(self, format, *args):
+        logging.debug("http: " + format, *args)
 
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
@@ -628,22 +3691,111 @@ class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         device = fields.get("device", [""])[0]
         arg = fields.get("arg", [""])[0]
         logging.info(f"web action [{action}] [{device}] [{arg}]")
-        wrapper = ACTION_MAP.get(action, RescanDevices)
-        wrapper(["", "", "", device, ""], arg)
+        if action not in ACTION_MAP:
+            action = "rescan"
+        COMMAND_DISPATCHER.Submit(Command(device, action, arg))
         self.send_response(301)
         self.send_header('Location', '/')
         self.end_headers()
 
 
-logging.info("starting mqtt handler")
-MQTT_CLIENT = MqttClient("mqtt2cast", ARGS.mqtt_broker,
-                         ARGS.mqtt_port, DISPATCH)
+############################################################
+# Startup
+# MQTT and the web server come up right away, the discovery
+# runs in the background. Progress is reported on sys/ready
+# and /ready.
+############################################################
+class StartupTracker:
+    """
+    Records when each startup stage completed
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.stages: Dict[str, float] = {}
+        self.ready = False
+
+    def Mark(self, stage: str, ready: bool = False):
+        global MQTT_CLIENT
+        self.stages[stage] = round(time.monotonic() - self.start, 3)
+        self.ready = self.ready or ready
+        logging.info(f"startup stage [{stage}] done after {self.stages[stage]}s")
+        if MQTT_CLIENT:
+            MQTT_CLIENT.EmitMessage(
+                NodeTopic(f"{MESSAGE_PREFIX}sys/ready"), json.dumps(self.Status()))
+
+    def Status(self) -> Dict[str, Any]:
+        global CAST_DEVICES
+        return {"ready": self.ready,
+                "stages": self.stages,
+                "devices": len(CAST_DEVICES.host_map) if CAST_DEVICES else 0,
+                "startup_seconds": self.stages.get("discovery")}
+
+
+def Start(args, client_name: str = "mqtt2cast"):
+    """
+    Creates the bridge components and connects to the broker.
+    The device discovery is started separately (see StartDiscovery).
+    """
+    global ARGS, STARTUP, COMMAND_DISPATCHER, EVENT_PUBLISHER, EVENT_STREAM
+    global HISTORY_STORE, PLAYLIST_CACHE, MIME_TYPE_CACHE
+    global MQTT_CLIENT, CAST_DEVICES, CLUSTER, RECORDER
+    ARGS = args
+    STARTUP = StartupTracker()
+    if ARGS.record:
+        RECORDER = Recorder(ARGS.record)
+    if ARGS.cluster_node:
+        CLUSTER = Cluster(ARGS.cluster_node, ARGS.cluster_heartbeat)
+        ROUTER.Register("cluster", 1, HandleClusterTopic)
+        ROUTER.Register("sys", 2, HandleSysTopic)
+    COMMAND_DISPATCHER = CommandDispatcher(ARGS.worker_queue_size)
+    EVENT_PUBLISHER = EventPublisher(ARGS.event_min_interval, ARGS.event_delta)
+    EVENT_STREAM = EventStream(ARGS.sse_buffer)
+    HISTORY_STORE = HistoryStore(ARGS.history_size)
+    PLAYLIST_CACHE = TtlCache("playlist", ARGS.playlist_cache_size,
+                              ARGS.playlist_cache_ttl, ARGS.playlist_cache_dir)
+    MIME_TYPE_CACHE = TtlCache("mime_type", ARGS.playlist_cache_size,
+                               ARGS.playlist_cache_ttl)
+    CAST_DEVICES = CastDeviceManager()
+
+    logging.info("starting mqtt handler")
+    MQTT_CLIENT = MqttClient(client_name, ARGS.mqtt_broker,
+                             ARGS.mqtt_port, ROUTER)
+    STARTUP.Mark("mqtt")
+    if CLUSTER:
+        CLUSTER.Start()
+
+
+def main():
+    global WEB_SERVER
+    args = PARSER.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if args.bench_router:
+        BenchRouter()
+        return
+
+    if not args.use_zeroconf and not args.scan_subnets:
+        print("you must specify either --use_zeroconf or at least one --scan_subnets=...")
+        quit(1)
+
+    # client names must be unique per broker
+    Start(args, f"mqtt2cast-{args.cluster_node}" if args.cluster_node else "mqtt2cast")
+
+    logging.info("starting web interfaces on port %d", ARGS.port)
+    WEB_SERVER = http.server.ThreadingHTTPServer(
+        (ARGS.host, ARGS.port), SimpleHTTPRequestHandler)
+    STARTUP.Mark("http")
 
-logging.info("start device manager")
-CAST_DEVICES = CastDeviceManager()
+    logging.info("start device discovery")
+    CAST_DEVICES.StartDiscovery()
+    WEB_SERVER.serve_forever()
 
 
-logging.info("starting web interfaces on port %d", ARGS.port)
-WEB_SERVER = http.server.HTTPServer(
-    (ARGS.host, ARGS.port), SimpleHTTPRequestHandler)
-WEB_SERVER.serve_forever()
+if __name__ == "__main__":
+    main()